@@ -8,38 +8,163 @@
     Arris SB6183; tested on firmware D30CM-OSPREY-2.4.0.1-GA-02-NOSH
     and the
     Arris SB8200; tested on firmware SB8200.0200.174F.311915.NSH.RT.NA
-
-    TODO: incorporate exponential backoff logic for speedtest, 
-        so it doesn't run too much if error or the speed stays low
-    TODO: save model number in state file, or just use a literal default,
-        so we report at least the config when modem is offline.
-    TODO: make retest test logic compute whether it's time to run based on our percentage
-        of departure from the baseline speed (a literal, else we have to store a running avg).
 """
 
 import datetime
+import errno
+import fcntl
+import gzip
+import hashlib
+import html.parser
 import json
 import math
+import mmap
 import os
 import re
+import socket
+import statistics
+import struct
 import subprocess
+import sys
+import tempfile
 import textwrap
-import requests
-from bs4 import BeautifulSoup
+import time
+from array import array
 
 STATEFUL_FILE_DIR_DEFAULT = '.'
-SPEEDTEST_JSON_FILE = 'speedtest.json'
+SPEEDTEST_JSON_FILE = 'speedtest.json'  # where results were kept before the history log
+SPEEDTEST_HISTORY_FILE = 'speedtest_history.jsonl'
+SPEEDTEST_HISTORY_MAX_BYTES = 262144  # then it's rotated to '.1', replacing the one before
+SPEEDTEST_HISTORY_WINDOW = 12  # tests behind the graph's medians
 SPEEDTEST_MAX_AGE = 55
 SPEEDTEST_EXPECTED_DOWNLOAD = 30
 SPEEDTEST_EXPECTED_UPLOAD = 3
 SPEEDTEST_RETEST_DOWNLOAD = 25000000
 SPEEDTEST_RETEST_UPLOAD = 1000000
-MODEM_STATUS_URL = 'http://192.168.100.1/'  # All Arris modems start here
+SPEEDTEST_RETEST_MINIMUM = 10  # minutes
+SPEEDTEST_MAX_BACKOFF = 240  # minutes, after repeated failures
+SPEEDTEST_DELAY = 75  # seconds between queueing a test and running it
+SPEEDTEST_SCHEDULE_FILE = 'speedtest_schedule.json'
+SPEEDTEST_LOCK_FILE = 'speedtest.lock'
+MODEM_HOST = '192.168.100.1'
+MODEM_STATUS_URL = 'http://' + MODEM_HOST + '/'  # All Arris modems start here; their other pages are in MODEM_PROFILES
+MODEM_LAYOUT_FILE = 'modem_layout.json'
+UPTIME_SCRAPE_RUNS = 12  # runs between fetches of the uptime page; in between, we extrapolate
+UPTIME_CACHE_FILE = 'uptime.json'
+COLLECT_INTERVAL = 300  # seconds between polls when run as 'arris.py collect'
+SNAPSHOT_MAX_AGE = 600  # seconds before a fetch stops trusting the collector's snapshot and scrapes itself
+SNAPSHOT_FILE = 'report.json'
+COLLECTOR_LOCK_FILE = 'collector.lock'  # held by the collector for as long as it runs
+SPOOL_INTERVAL = 0  # seconds between the collector's extra status-only samples, for spoolfetch; 0 for none
+SPOOL_FILE = 'spool.jsonl'
+SPOOL_LOCK_FILE = 'spool.lock'
+SPOOL_MAX_BYTES = 4194304  # past this, the oldest half of the spool is dropped
+SPOOL_FIELDS = ('model_name', 'downchan_id', 'upchan_id', 'downpower', 'downsnr', 'downfreq', 'upfreq', 'uppower',
+                'corrected_total', 'uncorrectable_total', 'downpowerspread', 'downsnrspread', 'uppowerspread',
+                'uptime_seconds', 'timing')
+SPOOL_SKIPPED = ('speedtest', 'next_hop_latency', 'latency_sampled', 'events')
+BURST_UNCORRECTABLE_JUMP = 100  # uncorrectable blocks since the last sample, all channels together, that start a burst
+BURST_SNR_DROP = 3.0  # dB fall in any downstream channel's SNR since the last sample, that starts a burst
+BURST_SPREAD_CHANGE = 3.0  # dB change in the downstream power spread since the last sample, that starts a burst
+BURST_INTERVAL = 10  # seconds between a burst's looks at the status page
+BURST_DURATION = 300  # seconds a burst lasts
+BURST_MIN_GAP = 3600  # seconds from the start of one burst to the next, so a lasting problem isn't captured nonstop
+BURST_FILE = 'burst.json'
+BURST_LOCK_FILE = 'burst.lock'
+BURST_ARCHIVE_FILE = 'bursts.jsonl.gz'
+BURST_ARCHIVE_MAX_BYTES = 8388608  # past this, it's rotated to .1, as the history logs are
+SERVE_ADDRESS = '127.0.0.1'  # 'serve' mode's OpenMetrics endpoint
+SERVE_PORT = 9727
+SERVE_INTERVAL = 60  # seconds; scrapes of the endpoint more often than this share one look at the modem
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+REPORT_CACHE_TTL = 60  # seconds a fetch may reuse the report scraped by another run
+REPORT_LOCK_FILE = 'report.lock'
+MODEM_HOSTS = ''  # fleet mode: the modems to poll, separated by spaces or commas
+FLEET_MAX_WORKERS = 8  # modems scraped at once in fleet mode
+FLEET_TIMEOUT = 5  # seconds per page request in fleet mode, so one dead modem can't stall the rest
+FLEET_SNAPSHOT_FILE = 'fleet_report{}.json'
+FLEET_LAYOUT_FILE = 'fleet_layout{}.json'
+FLEET_LOCK_FILE = 'fleet{}.lock'
+SAMPLE_RING_FILE = 'samples{}.ring'
+SAMPLE_RING_SLOTS = 288  # a day of 5-minute samples
+SAMPLE_RING_DOWN_CHANNELS = 34  # DOCSIS 3.1: 32 SC-QAM and 2 OFDM channels
+SAMPLE_RING_UP_CHANNELS = 10  # 8 SC-QAM and 2 OFDMA channels
+SPREAD_WINDOW = 12  # samples (an hour's worth) behind the rolling spread figures
+TIMING_STAGES = {  # the parts of a run that are timed, and their labels on the timing graph
+    'status': 'Status page',
+    'uptime': 'Uptime page',
+    'trace': 'Traceroute',
+    'ping': 'Ping',
+    'speedtest': 'Speedtest results',
+    'events': 'Event log page',
+    'emit': 'Graph output',
+}
+TIMING_LOG = '0'  # '1' to also write each run's timings to stderr, as a line of JSON
 LATENCY_GATEWAY_HOST = '8.8.4.4'
 LATENCY_GATEWAY_CMD = "/usr/sbin/traceroute -n --sim-queries=1 --wait=1 --queries=1 --max-hops="
 LATENCY_GATEWAY_HOPS = 2
 LATENCY_MEASURE_CMD = "/bin/ping -W 3 -nqc 3 "
+LATENCY_GATEWAY_MAX_AGE = 1440  # minutes to trust the hop found by traceroute
+GATEWAY_CACHE_FILE = 'gateway.json'
+LATENCY_PROBE = 'native'  # or 'commands', to use traceroute and ping instead of the built-in prober
+LATENCY_PROBE_COUNT = 5  # probes per measurement, by the built-in prober
+LATENCY_PROBE_PORT = 33434  # the first of the (unused) UDP ports probed, as traceroute does
+LATENCY_PROBE_SPACING = 0.2  # seconds between sending probes, as 'ping -i 0.2'
+LATENCY_PROBE_TIMEOUT = 3  # seconds to wait for the answers
+LATENCY_SAMPLE_INTERVAL = 1.0  # seconds between probes, when run as 'arris.py sample-latency'
+LATENCY_HISTOGRAM_FILE = 'latency.hist'
+LATENCY_HISTOGRAM_FLOOR = 0.1  # ms, the bottom of the histogram's lowest bucket
+LATENCY_HISTOGRAM_DECADES = 5  # so it reaches up to 10 seconds
+LATENCY_HISTOGRAM_STEPS = 20  # buckets per decade; percentiles come out within about 6%
+IP_RECVERR = 11  # from <linux/in.h>; the socket module doesn't name it
+SO_EE_ORIGIN_ICMP = 2
+MODEL_NUMBER_ID = 'thisModelNumberIs'
+DOWNSTREAM_HEADING = 'Downstream Bonded Channels'
+UPSTREAM_HEADING = 'Upstream Bonded Channels'
+NETWORK_ACCESS_LABEL = 'DOCSIS Network Access Enabled'
+UPTIME_LABEL = 'Up Time'
+MODEM_PROFILE_DEFAULT = {  # models not in MODEM_PROFILES are assumed to follow the SB8200
+    'uptime_page': 'cmswinfo.html',
+    'eventlog_page': 'cmeventlog.html',
+    'downstream_heading': DOWNSTREAM_HEADING,
+    'upstream_heading': UPSTREAM_HEADING,
+    'uptime_pattern': r'(\d+)\D+(\d+)h:(\d+)m:(\d+)s',  # days, hours, minutes, seconds
+}
+MODEM_PROFILES = {  # how each model differs from that; the status tables' columns are found from their headings
+    'SB6183': {'uptime_page': 'RgSwInfo.asp', 'eventlog_page': 'RgEventLog.asp'},
+    'SB8200': {},
+}
+STATUS_COLUMNS = {  # for each table, the headings each reading may be found under
+    'downstream': {'channel_id': ('Channel ID',), 'frequency': ('Frequency',), 'power': ('Power',),
+                   'snr': ('SNR', 'SNR/MER', 'MER'), 'corrected': ('Corrected',),
+                   'uncorrectable': ('Uncorrectables', 'Uncorrectable')},
+    'upstream': {'channel_id': ('Channel ID',), 'frequency': ('Frequency',), 'power': ('Power',)},
+}
+COLUMN_MAP_FILE = 'column_maps.json'
+COLUMN_MAPS_KEPT = 16  # model/firmware layouts remembered
+EVENTLOG_HEADING = 'Event Log'
+EVENT_MARK_FILE = 'events_seen{}.json'  # the newest event log entry already counted
+EVENT_LOG_FILE = 'events{}.jsonl'  # every entry seen, for grepping later
+EVENT_LOG_MAX_BYTES = 262144  # then it's rotated to '.1', replacing the one before
+EVENT_TIME_FORMATS = ('%a %b %d %H:%M:%S %Y', '%m/%d/%Y %H:%M:%S', '%m/%d/%Y %H:%M', '%Y-%m-%d %H:%M:%S')
+EVENT_SEVERITIES = {  # the DOCSIS event priorities, which the log shows as e.g. 'Critical (3)'
+    1: 'emergency', 2: 'alert', 3: 'critical', 4: 'error',
+    5: 'warning', 6: 'notice', 7: 'information', 8: 'debug',
+}
+EVENT_TYPES = (  # field, label and pattern; the first to match an entry's description counts it
+    ('t3', 'T3 timeouts', r'T3 time-?out'),
+    ('t4', 'T4 timeouts', r'T4 time-?out'),
+    ('ranging', 'Other ranging problems', r'[Rr]ang(e|ing)'),
+    ('sync', 'Lost sync or lock', r'SYNC|[Ss]ync|Lost MDD|[Ll]ock'),
+    ('reset', 'Resets and restarts', r'[Rr]eset|[Rr]eboot|[Cc]old [Ss]tart|[Ww]arm [Ss]tart'),
+    ('provisioning', 'DHCP, ToD and config file', r'DHCP|ToD|TOD|[Cc]onfig'),
+    ('other', 'Other', ''),
+)
 report = {}
+runDeadline = None  # when this run must be done by (time.monotonic()), if munin's waiting on it
+RUN_BUDGET = 8  # seconds a munin run may take; munin-node gives up on a plugin after 10
+STATUS_MIN_BUDGET = 1  # seconds that must be left to start on the status page, else the last report's shown
+LOW_PRIORITY_BUDGET = 4  # seconds that must be left to start on the uptime page, latency or event log
 SPEEDTEST_CMD = "/usr/bin/speedtest-cli --json"
 # ===== Force use of server(s) ======
 # SPEEDTEST_CMD += " --server 14162"  # ND's server
@@ -56,12 +181,15 @@ SPEEDTEST_CMD = "/usr/bin/speedtest-cli --json"
 
 
 def main(args):
-    global report, MODEM_STATUS_URL
+    global report, MODEM_HOST, MODEM_STATUS_URL
 
-    try:  # for testing against a file copy of the HTML
-        MODEM_STATUS_URL = os.environ['MODEM_STATUS_URL']
-    except KeyError:
-        pass
+    # MODEM_STATUS_URL may be a file copy of the HTML, for testing; if it's a web address, the
+    # modem's other pages are looked for on the same host, unless MODEM_HOST says otherwise
+    MODEM_STATUS_URL = os.environ.get('MODEM_STATUS_URL', 'http://' + os.environ.get('MODEM_HOST', MODEM_HOST) + '/')
+    if 'MODEM_HOST' in os.environ:
+        MODEM_HOST = os.environ['MODEM_HOST']
+    elif MODEM_STATUS_URL.startswith('http'):
+        MODEM_HOST = MODEM_STATUS_URL.split('/')[2]
 
     try:  # recent Munin will pass this var, indicating we can return values when asked for config info
         # has to exist and be '1'
@@ -69,33 +197,74 @@ def main(args):
     except KeyError:
         dirtyConfig = False
 
-    # this call also sets report['model_name']
-    if not getStatusIntoReport(MODEM_STATUS_URL):
-        # return False
-        report['model_name'] = 'modem_offline'
-        latencyValid = False
-        report['uptime_seconds'] = 0
-    else:
-        modem_uptime_url = ''  # this page's URL varies by modem model
-        if 'SB6183' in report['model_name']:
-            modem_uptime_url = 'http://192.168.100.1/RgSwInfo.asp'
-        if 'SB8200' in report['model_name']:
-            modem_uptime_url = 'http://192.168.100.1/cmswinfo.html'
+    if 'collect' in args:
+        return runCollector(args)
+    if 'spoolfetch' in args:
+        return runSpoolFetch(args)
+    if 'serve' in args:
+        return runServer(args)
+    if 'sample-latency' in args:
+        return runLatencySampler()
+    if 'speedtest' in args:
+        return runSpeedTest(args)
+    if 'burst' in args:
+        return runBurst()
+    startRunBudget()
+    hosts = fleetHosts(args)
+    if hosts:
+        return runFleet(args, dirtyConfig, hosts)
 
-        if 'http' in MODEM_STATUS_URL:
-            if not getModemUptime(modem_uptime_url):
+    if 'config' in args and not dirtyConfig:
+        # the graphs' labels are all that's needed, so print them from the layout the last fetch saw
+        loadLayoutIntoReport(report, loadStateFile(MODEM_LAYOUT_FILE))
+        report['next_hop_latency'] = ''
+        if os.path.exists(stateFilePath(LATENCY_HISTOGRAM_FILE)):
+            report['latency_sampled'] = {}
+        loadSpeedtestHistoryIntoReport()
+        printReport(args, dirtyConfig, report)
+        return True
+
+    stale = False
+    snapshot = loadStateFile(SNAPSHOT_FILE)
+    if collectorSnapshotIsFresh(snapshot):  # it's done the work, so all we do is print its latest
+        report.update(snapshot['report'])
+    else:
+        try:
+            if not collectIntoSnapshot(args, float(os.environ.get('REPORT_CACHE_TTL', REPORT_CACHE_TTL))):
                 return False
-            latencyValid = getNextHopLatency()
-        else:  # we're testing using a file, skip this stuff
-            latencyValid = False
-            report['uptime_seconds'] = 0
+        except TimeoutError:  # another run had the modem all the time we had; print what it last saw
+            print("# modem busy with another run; reporting its last report as stale", file=sys.stderr)
+            loadLayoutIntoReport(report, loadStateFile(MODEM_LAYOUT_FILE))
+            report.update(loadStateFile(SNAPSHOT_FILE).get('report', {}))
+            stale = True
 
-    speedTestDataExist = checkSpeedtestData(args)
+    printReport(args, dirtyConfig, report, stale)
+    return True
+    # end main()
+
+
+def printReport(args, dirtyConfig, aReport, stale=False, graphSuffix='', timestamp=None):
+    # for spoolfetch, each value carries the time it was taken
+    def stamped(value):
+        return value if timestamp is None else '{}:{}'.format(int(timestamp), value)
+
+    # values from a stale snapshot are reported as unknown, rather than repeating old ones
+    def fresh(value):
+        return 'U' if stale else stamped(value)
+
+    emitStarted = time.perf_counter()
+
+    latencyValid = aReport.get('next_hop_latency', '') != ''
+    speedTestDataExist = bool(aReport.get('speedtest'))
+    title = aReport['model_name']
+    if 'host' in aReport:
+        title += ' @' + aReport['host']
 
     # ==== report emission starts here ====
 
-    print('\nmultigraph wan_speedtest')
-    if 'config' in args:
+    if 'speedtest' in aReport:  # this and the latency graph are about our site, not any one modem
+        print('\nmultigraph wan_speedtest' + graphSuffix)
+    if 'config' in args and 'speedtest' in aReport:
         print(textwrap.dedent("""\
         graph_title {} [01]: Speedtest
         graph_vlabel ( see legend )
@@ -107,13 +276,17 @@ def main(args):
         up.label Upload (Mb/s)
         up.colour 44aa99
         distance.colour d19797
-        distance.label 'Distance' ( """).format(report['model_name']), end="")
+        down_median.label Download, median on this server
+        down_median.colour 0066cc
+        up_median.label Upload, median on this server
+        up_median.colour 44aa99
+        distance.label 'Distance' ( """).format(title), end="")
         try:
-            print(report['speedtest']['server']['sponsor'], ')')
+            print(aReport['speedtest']['server']['sponsor'], ')')
         except KeyError:
             print('server)')
         try:
-            testTime = datetime.datetime.fromisoformat(report['speedtest']['timestamp'][:-1])
+            testTime = datetime.datetime.fromisoformat(aReport['speedtest']['timestamp'][:-1])
         except KeyError:
             testTime = datetime.datetime.now()
         print(textwrap.dedent("""\
@@ -122,19 +295,23 @@ def main(args):
         # ping.label Ping (ms)
     if (dirtyConfig or (not 'config' in args)) and speedTestDataExist:
         try:
-            downloadspeed = float(report['speedtest']['download'] / 1000000)
-            uploadspeed = float(report['speedtest']['upload'] / 1000000)
+            downloadspeed = float(aReport['speedtest']['download'] / 1000000)
+            uploadspeed = float(aReport['speedtest']['upload'] / 1000000)
             # fiddle with the miles so the lines on the graph don't coincide/vary as much
-            distance = math.log(max(1, float(report['speedtest']['server']['d']) - 3)) + 10
-            print('down.value', downloadspeed)
-            print('up.value', uploadspeed)
-            print('distance.value', distance)
-            # print('ping.value', float(report['speedtest']['ping']))
+            distance = math.log(max(1, float(aReport['speedtest']['server']['d']) - 3)) + 10
+            print('down.value', fresh(downloadspeed))
+            print('up.value', fresh(uploadspeed))
+            print('distance.value', fresh(distance))
+            # print('ping.value', float(aReport['speedtest']['ping']))
         except KeyError:
             pass
+        medians = aReport.get('speedtest_medians', {})
+        print('down_median.value', fresh(medians.get('download', 'U')))
+        print('up_median.value', fresh(medians.get('upload', 'U')))
 
-    print('\nmultigraph wan_ping')
-    if 'config' in args:
+    if 'next_hop_latency' in aReport:
+        print('\nmultigraph wan_ping' + graphSuffix)
+    if 'config' in args and 'next_hop_latency' in aReport:
         print(textwrap.dedent("""\
         graph_title {} [02]: Latency
         graph_vlabel millliSeconds
@@ -142,13 +319,46 @@ def main(args):
         graph_args --alt-autoscale --upper-limit 33 --lower-limit 0 --rigid --allow-shrink
         graph_scale no
         latency.colour cc2900
-        latency.label Latency for """).format(report['model_name']), end="")
+        latency.label Latency for """).format(title), end="")
         print(LATENCY_GATEWAY_HOPS, "hops")
         # print('latency.min 7')  # an artificial and arbitrary floor, so the graph never spikes to zero
     if (dirtyConfig or (not 'config' in args)) and latencyValid:
-        print('latency.value', report['next_hop_latency'])
+        print('latency.value', fresh(aReport['next_hop_latency']))
+
+    if 'latency_sampled' in aReport:  # from 'arris.py sample-latency', between our runs
+        # on graphs of their own: the spikes they're for would be cut off by wan_ping's fixed scale
+        print('\nmultigraph wan_ping_sampled' + graphSuffix)
+        if 'config' in args:
+            print(textwrap.dedent("""\
+            graph_title {} [02]: Latency between polls
+            graph_vlabel millliSeconds
+            graph_category x-wan
+            graph_args --lower-limit 0
+            graph_scale no
+            p50.label Median
+            p95.label 95th percentile
+            p99.label 99th percentile
+            p99.colour ff9900
+            """).format(title), end='')
+        if dirtyConfig or (not 'config' in args):
+            for field in ('p50', 'p95', 'p99'):
+                print(field + '.value', fresh(aReport['latency_sampled'].get(field, 'U')))
 
-    print('\nmultigraph wan_downpower')
+        print('\nmultigraph wan_ping_loss' + graphSuffix)
+        if 'config' in args:
+            print(textwrap.dedent("""\
+            graph_title {} [02]: Packet Loss between polls
+            graph_vlabel %
+            graph_category x-wan
+            graph_args --lower-limit 0 --upper-limit 100
+            graph_scale no
+            loss.label Loss
+            loss.colour 000000
+            """).format(title), end='')
+        if dirtyConfig or (not 'config' in args):
+            print('loss.value', fresh(aReport['latency_sampled'].get('loss', 'U')))
+
+    print('\nmultigraph wan_downpower' + graphSuffix)
     if 'config' in args:
         print(textwrap.dedent("""\
         graph_title {} [03]: Downstream Power
@@ -156,14 +366,14 @@ def main(args):
         graph_category x-wan
         graph_scale no
         graph_args --alt-autoscale --lower-limit -15 --upper-limit 15
-	    """).format(report['model_name']))
-        for chan in report['downpower']:
-            print('down-power-ch' + chan + '.label', 'ch' + report['downchan_id'][chan])
+	    """).format(title))
+        for chan in aReport['downpower']:
+            print('down-power-ch' + chan + '.label', 'ch' + aReport['downchan_id'][chan])
     if dirtyConfig or (not 'config' in args):
-        for chan in report['downpower']:
-            print('down-power-ch' + chan + '.value', report['downpower'][chan])
+        for chan in aReport['downpower']:
+            print('down-power-ch' + chan + '.value', fresh(aReport['downpower'][chan]))
 
-    print('\nmultigraph wan_downsnr')
+    print('\nmultigraph wan_downsnr' + graphSuffix)
     if 'config' in args:
         print(textwrap.dedent("""\
         graph_title {} [04]: Downstream SNR
@@ -171,32 +381,32 @@ def main(args):
         graph_category x-wan
         graph_scale no
         graph_args --alt-autoscale --lower-limit 33
-        """).format(report['model_name']), end='')
-        for chan in report['downsnr']:
-            print('down-snr-ch' + chan + '.label', 'ch' + report['downchan_id'][chan])
+        """).format(title), end='')
+        for chan in aReport['downsnr']:
+            print('down-snr-ch' + chan + '.label', 'ch' + aReport['downchan_id'][chan])
     if dirtyConfig or (not 'config' in args):
-        for chan in report['downsnr']:
-            print('down-snr-ch' + chan + '.value', report['downsnr'][chan])
+        for chan in aReport['downsnr']:
+            print('down-snr-ch' + chan + '.value', fresh(aReport['downsnr'][chan]))
 
-    print('\nmultigraph wan_frequencies')
+    print('\nmultigraph wan_frequencies' + graphSuffix)
     if 'config' in args:
         print(textwrap.dedent("""\
         graph_title {} [05]: Frequency Assignments
         graph_vlabel MHz
         graph_category x-wan
         graph_args --alt-autoscale
-        """).format(report['model_name']), end='')
-        for chan in report['downfreq']:
-            print('downfreq-ch' + chan + '.label', 'dn-ch' + report['downchan_id'][chan])
-        for chan in report['upfreq']:
-            print('upfreq-ch' + chan + '.label', 'up-ch' + report['upchan_id'][chan])
+        """).format(title), end='')
+        for chan in aReport['downfreq']:
+            print('downfreq-ch' + chan + '.label', 'dn-ch' + aReport['downchan_id'][chan])
+        for chan in aReport['upfreq']:
+            print('upfreq-ch' + chan + '.label', 'up-ch' + aReport['upchan_id'][chan])
     if dirtyConfig or (not 'config' in args):
-        for chan in report['downfreq']:
-            print('downfreq-ch' + chan + '.value', float(report['downfreq'][chan]) / 1000000)
-        for chan in report['upfreq']:
-            print('upfreq-ch' + chan + '.value', float(report['upfreq'][chan]) / 1000000)
+        for chan in aReport['downfreq']:
+            print('downfreq-ch' + chan + '.value', fresh(float(aReport['downfreq'][chan]) / 1000000))
+        for chan in aReport['upfreq']:
+            print('upfreq-ch' + chan + '.value', fresh(float(aReport['upfreq'][chan]) / 1000000))
 
-    print('\nmultigraph wan_error_corr')
+    print('\nmultigraph wan_error_corr' + graphSuffix)
     if 'config' in args:
         print(textwrap.dedent("""\
         graph_title {} [06]: Downstream Corrected
@@ -205,16 +415,16 @@ def main(args):
         graph_args --upper-limit 33 --rigid
         graph_period minute
         graph_scale no
-        """).format(report['model_name']), end='')
-        for chan in report['corrected_total']:
-            print('corrected-total-ch' + chan + '.label', 'ch' + report['downchan_id'][chan])
-            print('corrected-total-ch' + chan + '.type', 'COUNTER')
-            print('corrected-total-ch' + chan + '.min', '0')
+        """).format(title), end='')
+        for chan in aReport['corrected_total']:
+            print('corrected-ch' + chan + '.label', 'ch' + aReport['downchan_id'][chan])
+            print('corrected-ch' + chan + '.min', '0')
     if dirtyConfig or (not 'config' in args):
-        for chan in report['corrected_total']:
-            print('corrected-total-ch' + chan + '.value', report['corrected_total'][chan])
+        # rates worked out from our own sample history, which knows when the modem restarted
+        for chan in aReport['corrected_total']:
+            print('corrected-ch' + chan + '.value', fresh(aReport.get('corrected_rate', {}).get(chan, 'U')))
 
-    print('\nmultigraph wan_error_uncorr')
+    print('\nmultigraph wan_error_uncorr' + graphSuffix)
     if 'config' in args:
         print(textwrap.dedent("""\
         graph_title {} [07]: Downstream Uncorrectable
@@ -223,16 +433,15 @@ def main(args):
         graph_args --upper-limit 33 --rigid
         graph_period minute
         graph_scale no
-        """).format(report['model_name']), end='')
-        for chan in report['uncorrectable_total']:
-            print('uncorrected-total-ch' + chan + '.label', 'ch' + report['downchan_id'][chan])
-            print('uncorrected-total-ch' + chan + '.type', 'COUNTER')
-            print('uncorrected-total-ch' + chan + '.min', '0')
+        """).format(title), end='')
+        for chan in aReport['uncorrectable_total']:
+            print('uncorrected-ch' + chan + '.label', 'ch' + aReport['downchan_id'][chan])
+            print('uncorrected-ch' + chan + '.min', '0')
     if dirtyConfig or (not 'config' in args):
-        for chan in report['uncorrectable_total']:
-            print('uncorrected-total-ch' + chan + '.value', report['uncorrectable_total'][chan])
+        for chan in aReport['uncorrectable_total']:
+            print('uncorrected-ch' + chan + '.value', fresh(aReport.get('uncorrectable_rate', {}).get(chan, 'U')))
 
-    # print('\nmultigraph wan_errors')
+    # print('\nmultigraph wan_errors' + graphSuffix)
     # if 'config' in args:
     #     print(textwrap.dedent("""\
     #     graph_title {} [06]: Downstream Corrected/Uncorrectable
@@ -241,26 +450,26 @@ def main(args):
     #     graph_period minute
     #     graph_args --upper-limit 33 --lower-limit 33 --rigid
     #     graph_scale no
-    #     """).format(report['model_name']), end='')
-    #     for chan in report['uncorrectable_total']:
-    #         # print('uncorrected-total-ch' + chan + '.label', 'ch' + report['downchan_id'][chan])
+    #     """).format(title), end='')
+    #     for chan in aReport['uncorrectable_total']:
+    #         # print('uncorrected-total-ch' + chan + '.label', 'ch' + aReport['downchan_id'][chan])
     # #        print('uncorrected-total-ch' + chan + '.type', 'DERIVE')
     #         # print('uncorrected-total-ch' + chan + '.min', '0')
     #         print('uncorrected-total-ch' + chan + '.graph', 'no')
     # if dirtyConfig or (not 'config' in args):
-    #     for chan in report['uncorrectable_total']:
-    #         print('uncorrected-total-ch' + chan + '.value', report['uncorrectable_total'][chan])
+    #     for chan in aReport['uncorrectable_total']:
+    #         print('uncorrected-total-ch' + chan + '.value', aReport['uncorrectable_total'][chan])
     # if 'config' in args:
-    #     for chan in report['corrected_total']:
-    #         print('corrected-total-ch' + chan + '.label', 'ch' + report['downchan_id'][chan])
+    #     for chan in aReport['corrected_total']:
+    #         print('corrected-total-ch' + chan + '.label', 'ch' + aReport['downchan_id'][chan])
     # #        print('corrected-total-ch' + chan + '.type', 'DERIVE')
     #         # print('corrected-total-ch' + chan + '.min', '0')
     #         print('corrected-total-ch' + chan + '.negative', 'uncorrected-total-ch' + chan)
     # if dirtyConfig or (not 'config' in args):
-    #     for chan in report['corrected_total']:
-    #         print('corrected-total-ch' + chan + '.value', report['corrected_total'][chan])
+    #     for chan in aReport['corrected_total']:
+    #         print('corrected-total-ch' + chan + '.value', aReport['corrected_total'][chan])
 
-    print('\nmultigraph wan_uppower')
+    print('\nmultigraph wan_uppower' + graphSuffix)
     if 'config' in args:
         print(textwrap.dedent("""\
         graph_title {} [08]: Upstream Power
@@ -268,14 +477,14 @@ def main(args):
         graph_category x-wan
         graph_scale no
         graph_args --alt-autoscale --lower-limit 45 --upper-limit 51
-        """).format(report['model_name']), end='')
-        for chan in report['uppower']:
-            print('up-power-ch' + chan + '.label', 'ch' + report['upchan_id'][chan])
+        """).format(title), end='')
+        for chan in aReport['uppower']:
+            print('up-power-ch' + chan + '.label', 'ch' + aReport['upchan_id'][chan])
     if dirtyConfig or (not 'config' in args):
-        for chan in report['uppower']:
-            print('up-power-ch' + chan + '.value', report['uppower'][chan])
+        for chan in aReport['uppower']:
+            print('up-power-ch' + chan + '.value', fresh(aReport['uppower'][chan]))
 
-    print('\nmultigraph wan_spread')
+    print('\nmultigraph wan_spread' + graphSuffix)
     if 'config' in args:
         print(textwrap.dedent("""\
         graph_title {} [09]: Signal Quality Spread
@@ -286,13 +495,18 @@ def main(args):
         downpowerspread.label Downstream Power spread
         downsnrspread.label Downstream SNR spread
         uppowerspread.label Upstream Power spread
-        """).format(report['model_name']), end='')
+        downpowerspreadmax.label Downstream Power spread, 1h max
+        downsnrspreadmax.label Downstream SNR spread, 1h max
+        uppowerspreadmax.label Upstream Power spread, 1h max
+        """).format(title), end='')
     if dirtyConfig or (not 'config' in args):
-        print('downpowerspread.value', report['downpowerspread'])
-        print('downsnrspread.value', report['downsnrspread'])
-        print('uppowerspread.value', report['uppowerspread'])
+        print('downpowerspread.value', fresh(aReport['downpowerspread']))
+        print('downsnrspread.value', fresh(aReport['downsnrspread']))
+        print('uppowerspread.value', fresh(aReport['uppowerspread']))
+        for spread in ('downpowerspread', 'downsnrspread', 'uppowerspread'):
+            print(spread + 'max.value', fresh(aReport.get('spread_stats', {}).get(spread, {}).get('max', 'U')))
 
-    print('\nmultigraph wan_uptime')
+    print('\nmultigraph wan_uptime' + graphSuffix)
     if 'config' in args:
         print(textwrap.dedent("""\
         graph_title {} [10]: Uptime
@@ -302,171 +516,1542 @@ def main(args):
         graph_scale no
         uptime.label uptime
         uptime.draw AREA
-        """).format(report['model_name']), end='')
+        """).format(title), end='')
     if dirtyConfig or (not 'config' in args):
-        print('uptime.value', report['uptime_seconds'])
+        print('uptime.value', fresh(aReport['uptime_seconds']))
+
+    if 'events' in aReport:  # new entries in the modem's event log since the last scrape
+        print('\nmultigraph wan_events' + graphSuffix)
+        if 'config' in args:
+            print(textwrap.dedent("""\
+            graph_title {} [11]: Event Log, by type
+            graph_vlabel new entries
+            graph_category x-wan
+            graph_args --base 1000 --lower-limit 0
+            graph_scale no
+            """).format(title), end='')
+            for field, label, _ in EVENT_TYPES:
+                print(field + '.label', label)
+                print(field + '.draw', 'AREASTACK')
+        if dirtyConfig or (not 'config' in args):
+            for field, _, _ in EVENT_TYPES:
+                print(field + '.value', fresh(aReport['events'].get('types', {}).get(field, 'U')))
+
+        print('\nmultigraph wan_events_severity' + graphSuffix)
+        if 'config' in args:
+            print(textwrap.dedent("""\
+            graph_title {} [12]: Event Log, by priority
+            graph_vlabel new entries
+            graph_category x-wan
+            graph_args --base 1000 --lower-limit 0
+            graph_scale no
+            """).format(title), end='')
+            for level, severity in EVENT_SEVERITIES.items():
+                print(severity + '.label', severity.capitalize(), '(' + str(level) + ')')
+                print(severity + '.draw', 'AREASTACK')
+        if dirtyConfig or (not 'config' in args):
+            for severity in EVENT_SEVERITIES.values():
+                print(severity + '.value', fresh(aReport['events'].get('severity', {}).get(severity, 'U')))
+
+    print('\nmultigraph wan_plugin_pages' + graphSuffix)
+    if 'config' in args:
+        print(textwrap.dedent("""\
+        graph_title {} [13]: Modem Page Sizes
+        graph_vlabel bytes
+        graph_category x-wan
+        graph_args --base 1024 --lower-limit 0
+        status_bytes.label Status page
+        uptime_bytes.label Uptime page
+        """).format(title), end='')
+        if 'events' in aReport:
+            print('eventlog_bytes.label Event log page')
+    timing = dict(aReport.get('timing', {}))
+    if dirtyConfig or (not 'config' in args):
+        print('status_bytes.value', fresh(timing.get('status_bytes', 'U')))
+        print('uptime_bytes.value', fresh(timing.get('uptime_bytes', 'U')))
+        if 'events' in aReport:
+            print('eventlog_bytes.value', fresh(timing.get('eventlog_bytes', 'U')))
+
+    # how long this run (or the one that scraped the report) spent on each part, so a slowing
+    # modem shows up here before munin-node starts timing us out; our own output comes last
+    stages = ['status', 'uptime']
+    if 'next_hop_latency' in aReport:
+        stages += ['trace', 'ping']
+    if 'speedtest' in aReport:
+        stages.append('speedtest')
+    if 'events' in aReport:
+        stages.append('events')
+    print('\nmultigraph wan_plugin_timing' + graphSuffix)
+    if 'config' in args:
+        print(textwrap.dedent("""\
+        graph_title {} [14]: Plugin Timing
+        graph_vlabel milliSeconds
+        graph_category x-wan
+        graph_args --base 1000 --lower-limit 0
+        graph_scale no
+        """).format(title), end='')
+        for stage in stages + ['emit']:
+            print(stage + '.label', TIMING_STAGES[stage])
+    timing['emit'] = round((time.perf_counter() - emitStarted) * 1000, 1)
+    if dirtyConfig or (not 'config' in args):
+        for stage in stages:
+            print(stage + '.value', fresh(timing.get(stage, 0)))  # a stage skipped this time took no time
+        print('emit.value', stamped(timing['emit']))
+    if os.environ.get('TIMING_LOG', TIMING_LOG) == '1':
+        print(json.dumps({'time': time.time(), 'host': aReport.get('host', MODEM_HOST), 'args': args[1:],
+                          'timing': timing}), file=sys.stderr)
+    # end printReport()
+
+
+def runCollector(args):
+    # Poll the modem, the latency probe and the speedtest results on our own schedule, leaving
+    # a snapshot of each report for munin's fetch to read. In between, if SPOOL_INTERVAL is set,
+    # just the status page is sampled into the spool, for spoolfetch. Runs until killed.
+    interval = float(os.environ.get('COLLECT_INTERVAL', COLLECT_INTERVAL))
+    spoolInterval = float(os.environ.get('SPOOL_INTERVAL', SPOOL_INTERVAL))
+    nextCollect = 0
+    collectorLock = open(stateFilePath(COLLECTOR_LOCK_FILE), 'a')  # held until we exit; see collectorIsRunning()
+    try:
+        fcntl.flock(collectorLock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print("# another collector is already running", file=sys.stderr)
+        return False
+    while True:
+        started = time.time()
+        try:
+            # we keep our own time, not munin's: each look at the modem may take until the next is due
+            if started >= nextCollect:
+                nextCollect = started + interval
+                startRunBudget(max(interval, float(os.environ.get('RUN_BUDGET', RUN_BUDGET))))
+                collectIntoSnapshot(args)
+            else:
+                startRunBudget(max(spoolInterval, float(os.environ.get('RUN_BUDGET', RUN_BUDGET))))
+                spoolStatusSample()
+        except (FileNotFoundError, OSError, json.decoder.JSONDecodeError) as the_error:
+            print("# error from collector:", the_error, file=sys.stderr)
+        wake = min(nextCollect, started + spoolInterval) if spoolInterval > 0 else nextCollect
+        time.sleep(max(0, wake - time.time()))
+
+
+def spoolStatusSample():
+    # a quick look at just the status page, between the collector's full polls
+    aReport = {}
+    with open(stateFilePath(REPORT_LOCK_FILE), 'a') as lockFile:
+        lockBeforeDeadline(lockFile)
+        if not timed(aReport, 'status', getStatusIntoReport, MODEM_STATUS_URL, aReport, None,
+                     max(0.1, timeLeft(10))):
+            return False
+    uptimeCache = loadStateFile(UPTIME_CACHE_FILE)
+    aReport['uptime_seconds'] = (uptimeCache['uptime_seconds'] + time.time() - uptimeCache['scraped']) / 86400.0 \
+        if uptimeCache else 'U'
+    return appendToSpool({'timestamp': time.time(),
+                          'report': {key: aReport[key] for key in SPOOL_FIELDS if key in aReport}})
+
 
+def appendToSpool(sample):
+    # a status-only sample, or one of the collector's full polls (marked 'full'), for spoolfetch
+    with open(stateFilePath(SPOOL_LOCK_FILE), 'a') as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        try:
+            if os.path.getsize(stateFilePath(SPOOL_FILE)) > SPOOL_MAX_BYTES:  # nobody's been collecting
+                samples = readSpool()
+                writeSpool(samples[len(samples) // 2:])
+        except FileNotFoundError:
+            pass
+        return appendToHistory(SPOOL_FILE, sample, SPOOL_MAX_BYTES * 2)  # trimmed above first, so never rotated
+
+
+def runSpoolFetch(args):
+    # Munin's 'spoolfetch <timestamp>': everything sampled since then, the collector's full polls
+    # among it, each value stamped with its time. The spool is pruned of what munin had already,
+    # all but the sample just before, which the first error rates are worked out from.
+    try:
+        since = float(args[args.index('spoolfetch') + 1])
+    except (IndexError, ValueError):
+        since = 0
+    snapshot = loadStateFile(SNAPSHOT_FILE)
+    with open(stateFilePath(SPOOL_LOCK_FILE), 'a') as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        samples = readSpool()
+        consumed = [sample for sample in samples if sample['timestamp'] <= since]
+        if len(consumed) > 1:
+            writeSpool(samples[len(consumed) - 1:])
+    if not snapshot:
+        return False
+
+    printReport(['arris.py', 'config'], False, snapshot['report'])
+    snapshot['full'] = True
+    if not any(sample['timestamp'] == snapshot['timestamp'] for sample in samples):  # not from the collector
+        samples.append(snapshot)
+    # values are stamped to the second, and rrdtool refuses a second update in the same second:
+    # of the samples in one second, a full poll is kept if there is one, or else the first
+    bySecond = {}
+    for sample in sorted(samples, key=lambda sample: sample['timestamp']):
+        kept = bySecond.get(int(sample['timestamp']))
+        if kept is None or (sample.get('full') and not kept.get('full')):
+            bySecond[int(sample['timestamp'])] = sample
+    previous = None
+    latestFull = None
+    printed = int(since)
+    for sample in sorted(bySecond.values(), key=lambda sample: sample['timestamp']):
+        if previous is not None and sample['timestamp'] > previous['timestamp']:
+            sample['report']['corrected_rate'], sample['report']['uncorrectable_rate'] = \
+                errorRatesBetween(previous, sample)
+        elif not sample.get('full'):  # nothing before it to work its rates out from
+            sample['report']['corrected_rate'], sample['report']['uncorrectable_rate'] = {}, {}
+        previous = sample
+        if sample.get('full'):
+            latestFull = sample
+        elif latestFull:  # only the status page was sampled; leave out the graphs it didn't update
+            sample['report'] = dict({key: value for key, value in latestFull['report'].items()
+                                     if key not in SPOOL_SKIPPED}, **sample['report'])
+        else:  # and there's no earlier full poll to take the rest from, so it's left unknown
+            sample['report'] = dict({key: value for key, value in snapshot['report'].items()
+                                     if key not in SPOOL_SKIPPED + ('spread_stats',)}, **sample['report'])
+        if int(sample['timestamp']) > printed:
+            printed = int(sample['timestamp'])
+            printReport(['arris.py'], False, sample['report'], timestamp=sample['timestamp'])
     return True
-    # end main()
 
 
-def getStatusIntoReport(url):
+def errorRatesBetween(previous, current):
+    # per-minute corrected/uncorrectable blocks between two samples; as in SampleRing.errorRates(),
+    # any counter going backwards means the modem restarted and they all started over from zero
+    minutes = (current['timestamp'] - previous['timestamp']) / 60
+    rates = ({}, {})
+    deltas = []
+    for field, rate in zip(('corrected_total', 'uncorrectable_total'), rates):
+        for chan, value in current['report'].get(field, {}).items():
+            try:
+                deltas.append((rate, chan, float(value), float(value) - float(previous['report'][field][chan])))
+            except (KeyError, ValueError):
+                pass
+    restarted = any(delta < 0 for _, _, _, delta in deltas)
+    for rate, chan, value, delta in deltas:
+        rate[chan] = (value if restarted else delta) / minutes
+    return rates
+
+
+def readSpool():
+    samples = []
+    try:
+        with open(stateFilePath(SPOOL_FILE), 'r') as fhInput:
+            for line in fhInput:
+                try:
+                    samples.append(json.loads(line))
+                except ValueError:  # cut short
+                    pass
+    except (FileNotFoundError, OSError, PermissionError):
+        pass
+    return samples
+
+
+def checkForDegradation(args, previous, current, previousTime):
+    # Compare this sample with the last (taken at previousTime); if the line has taken a turn for
+    # the worse, start a burst of closer looks at the status page in the background, keeping the
+    # pages themselves.
+    if previousTime is None or \
+            time.time() - previousTime > 2 * float(os.environ.get('COLLECT_INTERVAL', COLLECT_INTERVAL)):
+        return False  # a poll or more was missed, and the counters have had all that time to add up
+    reasons = degradation(previous, current)
+    if not reasons:
+        return False
+    burst = loadStateFile(BURST_FILE)
+    if time.time() - burst.get('started', 0) < float(os.environ.get('BURST_MIN_GAP', BURST_MIN_GAP)):
+        return False
+    print("# line degraded:", ', '.join(reasons), file=sys.stderr)
+    return queueBurst(args, reasons, [(previousTime, previous), (None, current)])
+
+
+def degradation(previous, current):
+    # what got worse between two reports, if enough to be worth a closer look
+    if previous.get('model_name', 'modem_offline') == 'modem_offline':
+        return []
+
+    def numbers(aReport, key):
+        values = {}
+        for chan, value in aReport.get(key, {}).items():
+            try:
+                values[chan] = float(value)
+            except ValueError:
+                pass
+        return values
+
+    reasons = []
+    before, after = numbers(previous, 'uncorrectable_total'), numbers(current, 'uncorrectable_total')
+    deltas = [after[chan] - before[chan] for chan in after if chan in before]
+    if deltas and min(deltas) >= 0:  # any counter going backwards means a restart, not errors
+        if sum(deltas) >= float(os.environ.get('BURST_UNCORRECTABLE_JUMP', BURST_UNCORRECTABLE_JUMP)):
+            reasons.append('uncorrectable +{:.0f}'.format(sum(deltas)))
+    before, after = numbers(previous, 'downsnr'), numbers(current, 'downsnr')
+    for chan in after:
+        if chan in before and before[chan] - after[chan] >= float(os.environ.get('BURST_SNR_DROP', BURST_SNR_DROP)):
+            reasons.append('SNR ch{} {:+.1f}dB'.format(chan, after[chan] - before[chan]))
+    try:
+        change = float(current['downpowerspread']) - float(previous['downpowerspread'])
+        if abs(change) >= float(os.environ.get('BURST_SPREAD_CHANGE', BURST_SPREAD_CHANGE)):
+            reasons.append('power spread {:+.1f}dB'.format(change))
+    except (KeyError, TypeError, ValueError):
+        pass
+    return reasons
+
+
+def queueBurst(args, reasons, samples):
+    # Start 'arris.py burst' in the background, as queueSpeedTest() does for a speedtest, after
+    # archiving the (timestamp, report) samples that set it off; None is now
+    theCmd = [sys.executable, os.path.abspath(__file__), 'burst']
+    if 'noburst' in args:  # for testing this code w/o a burst of scrapes
+        print('# would have run:', ' '.join(theCmd), file=sys.stderr)
+        return False
+    lockFile = open(stateFilePath(BURST_LOCK_FILE), 'a')
+    try:
+        fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        now = time.time()
+        subprocess.Popen(theCmd, pass_fds=(lockFile.fileno(),), start_new_session=True,
+                         env=dict(os.environ, BURST_REASONS=json.dumps(reasons)),
+                         stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # only now that it's underway, or a failure to start it would hold off the next for BURST_MIN_GAP
+        saveStateFile(BURST_FILE, {'started': now, 'reasons': reasons})
+        for timestamp, aReport in samples:
+            archiveBurstSample({'timestamp': timestamp or now, 'reasons': reasons,
+                                'report': {key: aReport[key] for key in SPOOL_FIELDS if key in aReport}})
+        return True
+    except BlockingIOError:  # there's one underway already
+        return False
+    except OSError as the_error:
+        print("# error running", '"', ' '.join(theCmd), '"', the_error, file=sys.stderr)
+        return False
+    finally:
+        lockFile.close()
+
+
+def runBurst():
+    # The background half of queueBurst(): every BURST_INTERVAL seconds for BURST_DURATION, the
+    # status page as the modem sent it and what was made of it, into the archive. The event log
+    # is kept at the start and the end, without counting its entries (that's left to the graphs).
+    reasons = json.loads(os.environ.get('BURST_REASONS', '[]'))  # from queueBurst(), what set it off
+    interval = float(os.environ.get('BURST_INTERVAL', BURST_INTERVAL))
+    ends = time.time() + float(os.environ.get('BURST_DURATION', BURST_DURATION))
+    model = loadStateFile(MODEM_LAYOUT_FILE).get('model_name', '')
+
+    def archiveEventLog():
+        page = fetchPage(modemEventLogUrl(model))
+        if page is not None:
+            archiveBurstSample({'timestamp': time.time(), 'pages': {'eventlog': page}})
+
+    archiveEventLog()
+    while time.time() < ends:
+        started = time.time()
+        aReport = {}
+        pages = {}
+        startRunBudget(min(interval, float(os.environ.get('RUN_BUDGET', RUN_BUDGET))))
+        try:
+            with open(stateFilePath(REPORT_LOCK_FILE), 'a') as lockFile:  # taking turns with munin's runs
+                lockBeforeDeadline(lockFile)
+                timed(aReport, 'status', getStatusIntoReport, MODEM_STATUS_URL, aReport, None,
+                      max(0.1, timeLeft(10)), pages)
+        except TimeoutError:  # the modem's busy enough; skip this one
+            time.sleep(max(0, interval - (time.time() - started)))
+            continue
+        archiveBurstSample({'timestamp': started, 'reasons': reasons, 'pages': pages,
+                            'report': {key: aReport[key] for key in SPOOL_FIELDS if key in aReport}})
+        time.sleep(max(0, interval - (time.time() - started)))
+    archiveEventLog()
+    return True
+
+
+def fetchPage(url, timeout=10):
+    # a modem page just as it came, or None
+    if 'http' not in MODEM_STATUS_URL:  # we're testing using a file, skip this
+        return None
+    import requests
+    try:
+        return requests.get(url, timeout=timeout).text
+    except requests.exceptions.RequestException:
+        return None
+
+
+def archiveBurstSample(record):
+    # Each record is a gzip member of its own, so the archive stays readable (zcat, gzip.open)
+    # even if a burst is cut off mid-write. It's rotated once it's grown past its limit.
+    path = stateFilePath(BURST_ARCHIVE_FILE)
+    try:
+        if os.path.getsize(path) > BURST_ARCHIVE_MAX_BYTES:
+            os.replace(path, path + '.1')
+    except FileNotFoundError:
+        pass
+    try:
+        with open(path, 'ab') as fhOutput:
+            fhOutput.write(gzip.compress((json.dumps(record, separators=(',', ':')) + '\n').encode()))
+        return True
+    except (OSError, PermissionError) as the_error:
+        print("# error writing", path, the_error, file=sys.stderr)
+        return False
+
+
+def writeSpool(samples):
+    path = stateFilePath(SPOOL_FILE)
+    try:
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path), prefix=SPOOL_FILE + '.')
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'w') as fhOutput:
+            for sample in samples:
+                fhOutput.write(json.dumps(sample, separators=(',', ':')) + '\n')
+        os.replace(tmpPath, path)
+    except (OSError, PermissionError) as the_error:
+        print("# error writing", path, the_error, file=sys.stderr)
+
+
+def runServer(args):
+    # Serve the report at /metrics in OpenMetrics form, for Prometheus and the like. However many
+    # scrapers there are, the modem is looked at no more than once per SERVE_INTERVAL (nor at all
+    # while the collector is running); in between, they all get the same rendered response.
+    import http.server
+    import threading
+
+    interval = float(os.environ.get('SERVE_INTERVAL', SERVE_INTERVAL))
+    rendered = {'expires': 0, 'body': b''}
+    renderLock = threading.Lock()
+
+    def latestMetrics():
+        with renderLock:  # the first scraper in does the work; the rest wait for it, then share it
+            if time.monotonic() >= rendered['expires']:
+                rendered['body'] = renderMetrics(*collectForServer(args, interval)).encode()
+                rendered['expires'] = time.monotonic() + interval
+            return rendered['body']
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = latestMetrics()
+            self.send_response(200)
+            self.send_header('Content-Type', OPENMETRICS_CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    address = (os.environ.get('SERVE_ADDRESS', SERVE_ADDRESS), int(os.environ.get('SERVE_PORT', SERVE_PORT)))
+    server = http.server.ThreadingHTTPServer(address, MetricsHandler)
+    print("# serving metrics at http://{}:{}/metrics".format(*server.server_address[:2]), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return True
+
+
+def collectForServer(args, maxAge):
+    # the report, whether it's stale, and its time; a look at the modem of our own leaves the
+    # latency histogram, event log and sample ring to munin's polls, which each take their turn
     global report
+    snapshot = loadStateFile(SNAPSHOT_FILE)
+    if collectorSnapshotIsFresh(snapshot):
+        report.update(snapshot['report'])
+        return report, False, snapshot['timestamp']
+    startRunBudget(max(maxAge, float(os.environ.get('RUN_BUDGET', RUN_BUDGET))))  # until the next look is due
+    try:
+        collected = collectIntoSnapshot(args, maxAge, consume=False)
+        if not collected:
+            return {'model_name': 'modem_offline'}, True, time.time()
+    except TimeoutError:
+        snapshot = loadStateFile(SNAPSHOT_FILE)
+        return snapshot.get('report', {'model_name': 'modem_offline'}), True, snapshot.get('timestamp', time.time())
+    except (FileNotFoundError, OSError, json.decoder.JSONDecodeError) as the_error:
+        print("# error from collector:", the_error, file=sys.stderr)
+        return {'model_name': 'modem_offline'}, True, time.time()
+    return report, False, collected
+
+
+def renderMetrics(aReport, stale, timestamp):
+    # the report as OpenMetrics text, each channel's readings labelled with its channel id
+    def labels(**pairs):
+        return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                               .replace('\n', '\\n')) for name, value in pairs.items()) + '}'
+
+    def number(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    model = aReport.get('model_name', 'modem_offline')
+    up = 0 if stale or model == 'modem_offline' else 1
+    families = [('arris_up', 'gauge', 'Whether the modem answered and reports an Internet connection',
+                 [(labels(model=model), up)]),
+                ('arris_report_timestamp_seconds', 'gauge', 'When the modem was last looked at',
+                 [('', timestamp)])]
+    if up:
+        for name, kind, help, key, ids in (
+                ('arris_downstream_power_dbmv', 'gauge', 'Downstream channel power', 'downpower', 'downchan_id'),
+                ('arris_downstream_snr_db', 'gauge', 'Downstream channel signal-to-noise ratio', 'downsnr',
+                 'downchan_id'),
+                ('arris_downstream_frequency_hertz', 'gauge', 'Downstream channel frequency', 'downfreq',
+                 'downchan_id'),
+                ('arris_downstream_corrected', 'counter', 'Downstream blocks corrected', 'corrected_total',
+                 'downchan_id'),
+                ('arris_downstream_uncorrectable', 'counter', 'Downstream blocks uncorrectable',
+                 'uncorrectable_total', 'downchan_id'),
+                ('arris_upstream_power_dbmv', 'gauge', 'Upstream channel power', 'uppower', 'upchan_id'),
+                ('arris_upstream_frequency_hertz', 'gauge', 'Upstream channel frequency', 'upfreq', 'upchan_id')):
+            samples = [(labels(channel=chan, channel_id=aReport.get(ids, {}).get(chan, chan)), number(value))
+                       for chan, value in aReport.get(key, {}).items()]
+            families.append((name, kind, help, samples))
+        uptime = number(aReport.get('uptime_seconds'))
+        latency = number(aReport.get('next_hop_latency'))
+        speedtest = aReport.get('speedtest') or {}
+        for name, help, value in (
+                ('arris_downstream_power_spread_dbmv', 'Spread of downstream channel powers',
+                 aReport.get('downpowerspread')),
+                ('arris_downstream_snr_spread_db', 'Spread of downstream signal-to-noise ratios',
+                 aReport.get('downsnrspread')),
+                ('arris_upstream_power_spread_dbmv', 'Spread of upstream channel powers',
+                 aReport.get('uppowerspread')),
+                ('arris_uptime_seconds', 'Time since the modem started', uptime * 86400 if uptime else uptime),
+                ('arris_next_hop_latency_milliseconds', 'Round trip to the next hop router', latency),
+                ('arris_speedtest_download_bits_per_second', 'Latest speedtest download rate',
+                 speedtest.get('download')),
+                ('arris_speedtest_upload_bits_per_second', 'Latest speedtest upload rate', speedtest.get('upload')),
+                ('arris_speedtest_ping_milliseconds', 'Latest speedtest ping', speedtest.get('ping'))):
+            families.append((name, 'gauge', help, [('', number(value))]))
+
+    lines = []
+    for name, kind, help, samples in families:
+        samples = [(sampleLabels, value) for sampleLabels, value in samples if value is not None]
+        if not samples:
+            continue
+        lines.append('# TYPE {} {}'.format(name, kind))
+        lines.append('# HELP {} {}'.format(name, help))
+        for sampleLabels, value in samples:
+            lines.append('{}{}{} {}'.format(name, '_total' if kind == 'counter' else '', sampleLabels, repr(value)))
+    lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+
+def collectIntoSnapshot(args, maxAge=0, consume=True):
+    # Only one run at a time talks to the modem, whose little web server copes badly with
+    # overlapping requests. Any others wait on the lock, then share that run's report
+    # if it's less than maxAge seconds old. Raises TimeoutError if the run's time is up first.
+    # Returns the time of the report, or False if there's none.
+    # Unless consume, what each munin poll takes its turn at is left alone: the latency histogram
+    # isn't drained, the event log isn't read, no sample goes into the ring, and the report isn't
+    # saved as the snapshot (which another poll could then take for its own).
+    global report
+    with open(stateFilePath(REPORT_LOCK_FILE), 'a') as lockFile:
+        lockBeforeDeadline(lockFile)
+        snapshot = loadStateFile(SNAPSHOT_FILE)
+        if time.time() - snapshot.get('timestamp', 0) < maxAge:
+            report.update(snapshot['report'])
+            return snapshot['timestamp']
+        if timeLeft(STATUS_MIN_BUDGET) is not None and timeLeft(STATUS_MIN_BUDGET) < STATUS_MIN_BUDGET:
+            raise TimeoutError('too little time left to look at the modem')
+        if not collectIntoReport(consume):
+            return False
+        if not consume:
+            return time.time()
+        if report['model_name'] != 'modem_offline':
+            recordSamples(report, SAMPLE_RING_FILE.format(''))
+            checkForDegradation(args, snapshot.get('report', {}), report, snapshot.get('timestamp'))
+        timed(report, 'speedtest', checkSpeedtestData, args)
+        snapshot = {'timestamp': time.time(), 'report': report}
+        saveStateFile(SNAPSHOT_FILE, snapshot)
+        if 'collect' in args:  # for spoolfetch, in case munin-async comes by less often than we poll
+            appendToSpool(dict(snapshot, full=True))
+    return snapshot['timestamp']
+
+
+def collectorIsRunning():
+    # The collector holds its lock for as long as it runs, and the kernel lets go of it when the
+    # collector dies, however that happens; unlike a saved pid, nothing else can pass for it.
+    try:
+        with open(stateFilePath(COLLECTOR_LOCK_FILE), 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    except OSError:
+        pass
+    return False
+
+
+def collectorSnapshotIsFresh(snapshot):
+    # whether the collector's snapshot can stand in for a look at the modem; if the collector
+    # has fallen behind, say so, and whoever asked looks for themselves
+    if not collectorIsRunning():
+        return False
+    if time.time() - snapshot.get('timestamp', 0) <= float(os.environ.get('SNAPSHOT_MAX_AGE', SNAPSHOT_MAX_AGE)):
+        return True
+    print("# collector's snapshot is stale, as of (local time):",
+          datetime.datetime.fromtimestamp(snapshot.get('timestamp', 0)).isoformat(), file=sys.stderr)
+    return False
+
+
+def collectIntoReport(consume=True):
+    # Fetch the status page, the uptime page and the latency probe all at once, since each is
+    # mostly waiting on the network. The uptime page's URL depends on the model, so it's started
+    # from the model seen last time and re-fetched only if that guess turns out wrong.
+    # Uptime just follows the clock, so that slow page is only scraped every UPTIME_SCRAPE_RUNS
+    # runs, or when the error counters go backwards (the modem rebooted); otherwise the last
+    # scraped value is carried forward. Unless consume, the latency histogram and the event log
+    # are left for the next run that does.
+    global report
+
+    report['timing'] = {}
+    report['next_hop_latency'] = ''
+    report['events'] = {}
+    report.pop('latency_sampled', None)
+    if consume and os.path.exists(stateFilePath(LATENCY_HISTOGRAM_FILE)):
+        with LatencyHistogram(stateFilePath(LATENCY_HISTOGRAM_FILE)) as histogram:
+            report['latency_sampled'] = histogram.drain()
+    layout = loadStateFile(MODEM_LAYOUT_FILE)
+    guessedUptimeUrl = modemUptimeUrl(layout.get('model_name', ''))
+    uptimeCache = loadStateFile(UPTIME_CACHE_FILE)
+    scrapeUptime = uptimeCache.get('runs', UPTIME_SCRAPE_RUNS) >= UPTIME_SCRAPE_RUNS
+    uptimeValid = False
+    uptimeScraped = False
+    # Within munin's time limit, the status page comes first; the rest is only started with
+    # enough time left, and whatever isn't done by the deadline is reported as unknown. Each job
+    # fills a report of its own, merged into ours only once it's done, so one still running
+    # past the deadline can't change the report while it's being saved or printed.
+    import concurrent.futures  # only here, so that 'config' needn't wait for it to load
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=3)
+    try:
+        statusJob = submitJob(pool, 'status', getStatusIntoReport, MODEM_STATUS_URL, None, max(0.1, timeLeft(10)))
+        if 'http' in MODEM_STATUS_URL:
+            latencyJob = submitJob(pool, None, getNextHopLatency) if lowPriorityAllowed() else None
+            uptimeJob = submitJob(pool, 'uptime', getModemUptime, guessedUptimeUrl, layout.get('model_name', ''),
+                                  None, timeLeft(25)) \
+                if scrapeUptime and guessedUptimeUrl and lowPriorityAllowed() else None
+        statusValid = jobResult(statusJob, untilDeadline=False)  # this also sets report['model_name']
+        if statusValid:
+            saveLayoutIfChanged(layout)
+        if statusValid and 'http' in MODEM_STATUS_URL:
+            eventsJob = submitJob(pool, 'events', getModemEventsIntoReport, modemEventLogUrl(report['model_name']),
+                                  '', None, timeLeft(10)) if consume and lowPriorityAllowed() else None
+            modem_uptime_url = modemUptimeUrl(report['model_name'])
+            rebooted = errorCountersWentBackwards(uptimeCache.get('errors', {}))
+            if uptimeJob and modem_uptime_url == guessedUptimeUrl:
+                uptimeScraped = jobResult(uptimeJob)
+            elif (scrapeUptime or rebooted) and lowPriorityAllowed():
+                if uptimeJob:  # guessed the wrong page; let that finish before asking for the right one
+                    jobResult(uptimeJob)
+                uptimeScraped = timed(report, 'uptime', getModemUptime, modem_uptime_url, report,
+                                      report['model_name'], None, timeLeft(25))
+            if uptimeScraped:
+                uptimeValid = True
+            elif uptimeCache and not rebooted:  # not scraped this time; carry the last scraped value forward
+                report['uptime_seconds'] = \
+                    (uptimeCache['uptime_seconds'] + time.time() - uptimeCache['scraped']) / 86400.0
+                uptimeValid = True
+            else:
+                report['uptime_seconds'] = 'U'
+            if latencyJob:
+                jobResult(latencyJob)
+            if eventsJob:
+                jobResult(eventsJob)
+    finally:
+        pool.shutdown(wait=False)
+
+    if statusValid and uptimeValid:
+        if uptimeScraped:
+            uptimeCache = {'uptime_seconds': report['uptime_seconds'] * 86400, 'scraped': time.time(), 'runs': 0}
+        uptimeCache['runs'] += 1
+        uptimeCache['errors'] = {chan: [report['corrected_total'][chan], report['uncorrectable_total'][chan]]
+                                 for chan in report['corrected_total']}
+        saveStateFile(UPTIME_CACHE_FILE, uptimeCache)
+
+        # a modem reboot may well have moved us to another gateway, so trace it again next time
+        gatewayCache = loadStateFile(GATEWAY_CACHE_FILE)
+        if gatewayCache.get('gateway') and \
+                report['uptime_seconds'] * 86400 < time.time() - gatewayCache.get('discovered', 0):
+            saveStateFile(GATEWAY_CACHE_FILE, {})
+
+    if not statusValid:
+        report['model_name'] = 'modem_offline'
+        report['next_hop_latency'] = ''
+        report['uptime_seconds'] = 0
+    elif 'http' not in MODEM_STATUS_URL:  # we're testing using a file, skip this stuff
+        report['uptime_seconds'] = 0
+    elif not uptimeValid:
+        print("# no uptime from the modem; reporting the rest", file=sys.stderr)
+    return True
+
+
+def startRunBudget(seconds=None):
+    global runDeadline
+    runDeadline = time.monotonic() + (seconds or float(os.environ.get('RUN_BUDGET', RUN_BUDGET)))
+
+
+def lockBeforeDeadline(lockFile):
+    # flock(), but only waiting as long as the run has left; raises TimeoutError past that
+    if timeLeft() is None:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        return
+    while True:
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            if timeLeft() <= 0:
+                raise TimeoutError('lock ' + lockFile.name + ' still held at the deadline')
+            time.sleep(min(0.05, timeLeft()))
+
+
+def timeLeft(limit=None):
+    # seconds until this run's deadline, but no more than limit; None if neither applies
+    if runDeadline is None:
+        return limit
+    left = max(0.0, runDeadline - time.monotonic())
+    return left if limit is None else min(limit, left)
+
+
+def lowPriorityAllowed():
+    left = timeLeft()
+    return left is None or left >= float(os.environ.get('LOW_PRIORITY_BUDGET', LOW_PRIORITY_BUDGET))
+
+
+def submitJob(pool, stage, func, url=None, *args):
+    # Run func (timed as stage, if given) on a report of its own; jobResult() merges that into
+    # ours. The url, if any, comes before the report in func's arguments, as in getStatusIntoReport().
+    jobReport = {}
+    funcArgs = ((url,) if url is not None else ()) + (jobReport,) + args
+    job = pool.submit(timed, jobReport, stage, func, *funcArgs) if stage else pool.submit(func, *funcArgs)
+    job.jobReport = jobReport
+    return job
+
+
+def jobResult(job, untilDeadline=True):
+    # A stage's result, with its report merged into ours, or False if it isn't done by the
+    # deadline (and then whatever it goes on to find is left out).
+    import concurrent.futures
+    try:
+        result = job.result(timeout=timeLeft() if untilDeadline else None)
+    except concurrent.futures.TimeoutError:
+        return False
+    jobReport = dict(job.jobReport)
+    report.setdefault('timing', {}).update(jobReport.pop('timing', {}))
+    report.update(jobReport)
+    return result
+
+
+def errorCountersWentBackwards(priorErrors):
+    # the modem's error counters only ever climb, until it restarts
+    for chan, (corrected, uncorrectable) in priorErrors.items():
+        try:
+            if float(report['corrected_total'][chan]) < float(corrected) \
+                    or float(report['uncorrectable_total'][chan]) < float(uncorrectable):
+                return True
+        except (KeyError, ValueError):
+            pass
+    return False
+
+
+def saveLayoutIfChanged(layout):
+    # remember the model and channel line-up, for the next run's guesses and for 'config'
+    newLayout = {key: report[key] for key in ('model_name', 'downchan_id', 'upchan_id')}
+    if newLayout != layout:
+        saveStateFile(MODEM_LAYOUT_FILE, newLayout)
+
+
+def loadLayoutIntoReport(aReport, layout):
+    # just enough of a report for 'config' to print the graphs, from what the last fetch saw
+    aReport['model_name'] = layout.get('model_name', 'modem_offline')
+    aReport['downchan_id'] = layout.get('downchan_id', {})
+    aReport['upchan_id'] = layout.get('upchan_id', {})
+    for key in ('downpower', 'downsnr', 'downfreq', 'corrected_total', 'uncorrectable_total'):
+        aReport[key] = dict.fromkeys(aReport['downchan_id'], '')
+    for key in ('uppower', 'upfreq'):
+        aReport[key] = dict.fromkeys(aReport['upchan_id'], '')
+    aReport['uppowerspread'] = 0
+    aReport['downpowerspread'] = 0
+    aReport['downsnrspread'] = 0
+    aReport['uptime_seconds'] = 0
+    aReport['events'] = {}
+    return aReport
+
+
+def modemUptimeUrl(model_name, host=None):
+    return modemPageUrl('uptime_page', model_name, host)
+
+
+def modemEventLogUrl(model_name, host=None):
+    return modemPageUrl('eventlog_page', model_name, host)
+
+
+def modemPageUrl(page, model_name, host=None):
+    if not model_name:  # no model seen yet, so no idea
+        return ''
+    return 'http://' + (host or MODEM_HOST) + '/' + modemProfile(model_name)[page]
+
+
+def modemProfile(model_name):
+    for model, profile in MODEM_PROFILES.items():
+        if model in (model_name or ''):
+            return dict(MODEM_PROFILE_DEFAULT, **profile)
+    return MODEM_PROFILE_DEFAULT
+
+
+def fleetHosts(args):
+    # a 'wan_<host>' symlink graphs just that modem; otherwise MODEM_HOSTS (from the plugin's
+    # env settings in plugin-conf.d) may list several
+    pluginName = os.path.basename(args[0])
+    if pluginName.startswith('wan_'):
+        return [pluginName[len('wan_'):]]
+    return [host for host in re.split(r'[\s,]+', os.environ.get('MODEM_HOSTS', MODEM_HOSTS)) if host]
+
+
+def graphSuffixFor(host):
+    # munin wants graph names of letters, digits and underscores only
+    return '_' + re.sub('[^A-Za-z0-9_]', '_', host)
+
+
+def runFleet(args, dirtyConfig, hosts):
+    # One plugin graphing many modems, each with its own set of multigraphs named for its host.
+    # The latency and speedtest graphs are about the site this runs at, so they're left to 'wan'.
+    instance = graphSuffixFor(hosts[0]) if os.path.basename(args[0]).startswith('wan_') else ''
+    stale = False
+    if 'config' in args and not dirtyConfig:
+        layouts = loadStateFile(FLEET_LAYOUT_FILE.format(instance))
+        reports = {host: loadLayoutIntoReport({}, layouts.get(host, {})) for host in hosts}
+    else:
+        try:
+            reports = collectFleetIntoSnapshot(hosts, instance,
+                                               float(os.environ.get('REPORT_CACHE_TTL', REPORT_CACHE_TTL)))
+        except TimeoutError:  # as in main(), what the other run last saw, as stale
+            print("# modems busy with another run; reporting its last reports as stale", file=sys.stderr)
+            snapshot = loadStateFile(FLEET_SNAPSHOT_FILE.format(instance))
+            layouts = loadStateFile(FLEET_LAYOUT_FILE.format(instance))
+            reports = {host: snapshot.get(host, {}).get('report') or loadLayoutIntoReport({}, layouts.get(host, {}))
+                       for host in hosts}
+            stale = True
+    for host in hosts:
+        reports[host]['host'] = host
+        printReport(args, dirtyConfig, reports[host], stale, graphSuffix=graphSuffixFor(host))
+    return True
+
+
+def collectFleetIntoSnapshot(hosts, instance, maxAge=0):
+    # As collectIntoSnapshot(), but the snapshot holds a report per host, so only the hosts
+    # missing from it or gone stale are scraped again.
+    with open(stateFilePath(FLEET_LOCK_FILE.format(instance)), 'a') as lockFile:
+        lockBeforeDeadline(lockFile)
+        snapshot = loadStateFile(FLEET_SNAPSHOT_FILE.format(instance))
+        now = time.time()
+        due = [host for host in hosts if now - snapshot.get(host, {}).get('timestamp', 0) >= maxAge]
+        if due:
+            for host, aReport in collectFleetReports(due).items():
+                if aReport['model_name'] != 'modem_offline':
+                    recordSamples(aReport, SAMPLE_RING_FILE.format(graphSuffixFor(host)))
+                snapshot[host] = {'timestamp': time.time(), 'report': aReport}
+            saveStateFile(FLEET_SNAPSHOT_FILE.format(instance), snapshot)
+            layouts = loadStateFile(FLEET_LAYOUT_FILE.format(instance))
+            newLayouts = dict(layouts)
+            for host in due:
+                if snapshot[host]['report']['model_name'] != 'modem_offline':
+                    newLayouts[host] = {key: snapshot[host]['report'][key]
+                                        for key in ('model_name', 'downchan_id', 'upchan_id')}
+            if newLayouts != layouts:
+                saveStateFile(FLEET_LAYOUT_FILE.format(instance), newLayouts)
+    return {host: snapshot[host]['report'] for host in hosts}
+
+
+def collectFleetReports(hosts):
+    # scrape each modem on its own thread, a bounded number at a time
+    timeout = float(os.environ.get('FLEET_TIMEOUT', FLEET_TIMEOUT))
+    workers = min(len(hosts), int(os.environ.get('FLEET_MAX_WORKERS', FLEET_MAX_WORKERS)))
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        jobs = {host: pool.submit(collectModemReport, host, timeout) for host in hosts}
+        return {host: job.result() for host, job in jobs.items()}
+
+
+def collectModemReport(host, timeout):
+    # the status, uptime and event log pages of one modem, over one keep-alive connection
+    import requests
+    aReport = {'events': {}}
+    with requests.Session() as session:
+        if not timed(aReport, 'status', getStatusIntoReport, 'http://' + host + '/', aReport, session,
+                     max(0.1, timeLeft(timeout))):
+            print("# no report from the modem at", host, file=sys.stderr)
+            aReport['model_name'] = 'modem_offline'
+            aReport['uptime_seconds'] = 0
+        elif not lowPriorityAllowed() or \
+                not timed(aReport, 'uptime', getModemUptime, modemUptimeUrl(aReport['model_name'], host),
+                          aReport, aReport['model_name'], session, timeLeft(timeout)):
+            print("# no uptime from the modem at", host, file=sys.stderr)
+            aReport['uptime_seconds'] = 'U'
+        if aReport['model_name'] != 'modem_offline' and lowPriorityAllowed():
+            timed(aReport, 'events', getModemEventsIntoReport, modemEventLogUrl(aReport['model_name'], host),
+                  aReport, graphSuffixFor(host), session, timeLeft(timeout))
+    return aReport
+
+
+def getStatusIntoReport(url, aReport, session=None, timeout=10, pages=None):
 
     # setup empty dict's for the incoming data rows; do it here so these exist if this function fails to reach the modem
-    report['downsnr'] = {}
-    report['downpower'] = {}
-    report['uppower'] = {}
-    report['corrected_total'] = {}
-    report['uncorrectable_total'] = {}
-    report['downchan_id'] = {}
-    report['upchan_id'] = {}
-    report['downfreq'] = {}
-    report['upfreq'] = {}
-    report['uppowerspread'] = 0
-    report['downpowerspread'] = 0
-    report['downsnrspread'] = 0
+    aReport['downsnr'] = {}
+    aReport['downpower'] = {}
+    aReport['uppower'] = {}
+    aReport['corrected_total'] = {}
+    aReport['uncorrectable_total'] = {}
+    aReport['downchan_id'] = {}
+    aReport['upchan_id'] = {}
+    aReport['downfreq'] = {}
+    aReport['upfreq'] = {}
+    aReport['uppowerspread'] = 0
+    aReport['downpowerspread'] = 0
+    aReport['downsnrspread'] = 0
 
     # handle URLs that are web addresses, or local HTML file references for testing
-    if 'http' in MODEM_STATUS_URL:
+    if 'http' in url:
+        import requests  # only here, so that 'config' needn't wait for it to load
         try:
-            page = requests.get(url, timeout=10).text
+            page = (session or requests).get(url, timeout=timeout).text
+            aReport.setdefault('timing', {})['status_bytes'] = len(page)
         except requests.exceptions.RequestException:
             print("# modem status page not responding", file=sys.stderr)
             return False
     else:
         try:
-            fh = open(MODEM_STATUS_URL, 'r')
+            fh = open(url, 'r', errors='replace')  # as requests does with a page that isn't all it claims
             page = fh.read()
             fh.close()
         except (FileNotFoundError, OSError, PermissionError):
             print("# modem status-file read failure", file=sys.stderr)
             return False
 
+    if pages is not None:  # kept as it came, for a burst's archive
+        pages['status'] = page
+
     # drop some nasty characters
     page = page.translate(str.maketrans('', '', "\n\x00\x09\r"))
-    soup = BeautifulSoup(str(page), 'html5lib')
+    status = scrapeStatusPage(page)
+    if status is None:
+        print("# modem status page not understood", file=sys.stderr)
+        return False
 
-    model_name_tag = soup.find(id='thisModelNumberIs')
-    if model_name_tag:
-        report['model_name'] = model_name_tag.get_text()
+    if status['model_name'] is not None:
+        aReport['model_name'] = status['model_name']
     else:  # If no model # known, we can't continue very well
         return False
 
     # Be sure WAN is connected, else do not report
-    td = soup.find('td', string="DOCSIS Network Access Enabled")
-    internetStatus = td.parent()[1].get_text()
-    if 'Allowed' not in internetStatus:
+    if 'Allowed' not in status['access']:
         print("# Modem indicates no Internet Connection as of (local time):",
               datetime.datetime.now().isoformat(), file=sys.stderr)
         return False
 
     # the columnar position of these stats vary between models of modem (why? - seems silly)
-    if 'SB6183' in report['model_name']:
-        channel_id_col = 3
-        downfreq_col = 4
-        upfreq_col = 5
-        downpower_col = 5
-        uppower_col = 6
-        downsnr_col = 6
-        corrected_col = 7
-        uncorrectable_col = 8
-    elif 'SB8200' in report['model_name']:
-        channel_id_col = 0
-        downfreq_col = 3
-        upfreq_col = 4
-        downpower_col = 4
-        uppower_col = 6
-        downsnr_col = 5
-        corrected_col = 6
-        uncorrectable_col = 7
-    else:
-        # we don't know this modem's column numbers
+    columns = statusColumns(status, aReport['model_name'])
+    if columns is None:
+        print("# modem status tables' columns not recognized:", status['downstream_header'],
+              status['upstream_header'], file=sys.stderr)
         return False
 
-    # Gather the various data items from the tables...
-    block = soup.find('th', string="Downstream Bonded Channels").parent
-    block = block.next_sibling  # skip the 2 header rows
-    block = block.next_sibling
-    for row in block.next_siblings:
-        if isinstance(row, type(block)):
-            newRow = []
-            for column in row:  # grab all the row's numbers into a list
-                if isinstance(column, type(block)):
-                    newRow.append(re.sub("[^0-9.-]", "", column.get_text()))
-
-            report['downchan_id'][newRow[0]] = newRow[channel_id_col]
-            report['downpower'][newRow[0]] = newRow[downpower_col]
-            report['downsnr'][newRow[0]] = newRow[downsnr_col]
-            report['downfreq'][newRow[0]] = newRow[downfreq_col]
-
-            report['corrected_total'][newRow[0]] = newRow[corrected_col]
-            report['uncorrectable_total'][newRow[0]] = newRow[uncorrectable_col]
-
-    block = soup.find('th', string="Upstream Bonded Channels").parent
-    block = block.next_sibling  # skip the header rows
-    block = block.next_sibling
-    for row in block.next_siblings:
-        if isinstance(row, type(block)):
-            newRow = []
-            for column in row:
-                if isinstance(column, type(block)):
-                    newRow.append(re.sub("[^0-9.-]", "", column.get_text()))
-            report['upchan_id'][newRow[0]] = newRow[channel_id_col]
-            report['uppower'][newRow[0]] = newRow[uppower_col]
-            report['upfreq'][newRow[0]] = newRow[upfreq_col]
-
-    report['uppowerspread'] = max(float(i) for i in report['uppower'].values()) \
-        - min(float(i) for i in report['uppower'].values())
-    report['downpowerspread'] = max(float(i) for i in report['downpower'].values()) \
-        - min(float(i) for i in report['downpower'].values())
-    report['downsnrspread'] = max(float(i) for i in report['downsnr'].values()) \
-        - min(float(i) for i in report['downsnr'].values())
+    extractChannelsIntoReport(status, columns, aReport)
+    try:
+        computeSpreadsIntoReport(aReport)
+    except ValueError:  # a table with no rows, or numbers that aren't
+        print("# modem status tables not understood", file=sys.stderr)
+        return False
     return True
 
 
-def getModemUptime(url):
-    global report
+def statusColumns(status, model_name):
+    # Where each reading is in the status tables, worked out from their heading rows the first
+    # time this model's layout is seen, then remembered by a hash of those rows, so that a
+    # firmware update that moves them is noticed. None if some reading can't be found.
+    headers = [status['downstream_header'], status['upstream_header']]
+    key = model_name + ':' + hashlib.sha1(json.dumps(headers).encode()).hexdigest()[:12]
+    columnMaps = loadStateFile(COLUMN_MAP_FILE)
+    if key in columnMaps:
+        return columnMaps[key]
+
+    columns = {}
+    for table, header in zip(('downstream', 'upstream'), headers):
+        names = [' '.join(text.split()).lower() for text in header]
+        columns[table] = {}
+        for field, headings in STATUS_COLUMNS[table].items():
+            headings = [heading.lower() for heading in headings]
+            found = [i for i, name in enumerate(names) if name in headings] \
+                or [i for i, name in enumerate(names) if any(name.startswith(heading + ' ') for heading in headings)]
+            if found:
+                columns[table][field] = found[0]
+            elif field == 'channel_id':  # no separate id; the channel number will do
+                columns[table][field] = 0
+            else:
+                return None
+    columnMaps = dict(list(columnMaps.items())[-(COLUMN_MAPS_KEPT - 1):], **{key: columns})
+    saveStateFile(COLUMN_MAP_FILE, columnMaps)
+    return columns
+
+
+def extractChannelsIntoReport(status, columns, aReport):
+    # Gather the various data items from the tables...
+    down = columns['downstream']
+    for row in status['downstream']:
+        if len(row) <= max(down.values()):  # cut short
+            continue
+        newRow = [re.sub("[^0-9.-]", "", column) for column in row]  # grab all the row's numbers into a list
+
+        aReport['downchan_id'][newRow[0]] = newRow[down['channel_id']]
+        aReport['downpower'][newRow[0]] = newRow[down['power']]
+        aReport['downsnr'][newRow[0]] = newRow[down['snr']]
+        aReport['downfreq'][newRow[0]] = newRow[down['frequency']]
+
+        aReport['corrected_total'][newRow[0]] = newRow[down['corrected']]
+        aReport['uncorrectable_total'][newRow[0]] = newRow[down['uncorrectable']]
+
+    up = columns['upstream']
+    for row in status['upstream']:
+        if len(row) <= max(up.values()):
+            continue
+        newRow = [re.sub("[^0-9.-]", "", column) for column in row]
+        aReport['upchan_id'][newRow[0]] = newRow[up['channel_id']]
+        aReport['uppower'][newRow[0]] = newRow[up['power']]
+        aReport['upfreq'][newRow[0]] = newRow[up['frequency']]
+
+
+def computeSpreadsIntoReport(aReport):
+    aReport['uppowerspread'] = max(float(i) for i in aReport['uppower'].values()) \
+        - min(float(i) for i in aReport['uppower'].values())
+    aReport['downpowerspread'] = max(float(i) for i in aReport['downpower'].values()) \
+        - min(float(i) for i in aReport['downpower'].values())
+    aReport['downsnrspread'] = max(float(i) for i in aReport['downsnr'].values()) \
+        - min(float(i) for i in aReport['downsnr'].values())
+
+
+class ModemPageScraper(html.parser.HTMLParser):
+    # A single streaming pass over a modem page that keeps only the pieces asked for:
+    #   tables[heading] - the rows following the <th> heading's row, in that table
+    #   rows[label]     - the cells following the <td> label, in that row
+    #   elements[id]    - the text of the element with that id
+    # Rows are lists of cell texts, and cells are (tag, text) tuples.
+
+    def __init__(self, headings=(), labels=(), ids=()):
+        super().__init__()
+        self.headings = headings
+        self.labels = labels
+        self.ids = ids
+        self.tables = {}
+        self.rows = {}
+        self.elements = {}
+        self._frames = []  # one per open <table>, innermost last
+        self._capture = None  # [id, tag, depth, text pieces] while inside a wanted id
+
+    def handle_starttag(self, tag, attrs):
+        if self._capture:
+            if tag == self._capture[1]:
+                self._capture[2] += 1
+        else:
+            for name, value in attrs:
+                if name == 'id' and value in self.ids and value not in self.elements:
+                    self._capture = [value, tag, 1, []]
+        if tag == 'table':
+            self._frames.append({'row': None, 'cell': None, 'cell_tag': None, 'heading': None})
+        elif not self._frames:
+            return
+        elif tag == 'tr':
+            self._endRow(self._frames[-1])
+            self._frames[-1]['row'] = []
+        elif tag in ('td', 'th'):
+            frame = self._frames[-1]
+            self._endCell(frame)
+            if frame['row'] is None:  # a cell with no <tr>, the browser invents one
+                frame['row'] = []
+            frame['cell'] = []
+            frame['cell_tag'] = tag
+
+    def handle_endtag(self, tag):
+        if self._capture and tag == self._capture[1]:
+            self._capture[2] -= 1
+            if self._capture[2] == 0:
+                self.elements[self._capture[0]] = ''.join(self._capture[3])
+                self._capture = None
+        if not self._frames:
+            return
+        if tag in ('td', 'th'):
+            self._endCell(self._frames[-1])
+        elif tag == 'tr':
+            self._endRow(self._frames[-1])
+        elif tag == 'table':
+            self._endRow(self._frames.pop())
+
+    def handle_data(self, data):
+        if self._capture:
+            self._capture[3].append(data)
+        if not self._frames:
+            return
+        frame = self._frames[-1]
+        if frame['cell'] is not None:
+            frame['cell'].append(data)
+
+    def _endCell(self, frame):
+        if frame['cell'] is None:
+            return
+        frame['row'].append((frame['cell_tag'], ''.join(frame['cell'])))
+        frame['cell'] = None
+
+    def _endRow(self, frame):
+        self._endCell(frame)
+        row = frame['row']
+        if row is None:
+            return
+        frame['row'] = None
+        if frame['heading'] is not None:
+            self.tables[frame['heading']].append([text for _, text in row])
+        for i, (tag, text) in enumerate(row):
+            if tag == 'th' and text in self.headings and text not in self.tables:
+                frame['heading'] = text
+                self.tables[text] = []
+            elif tag == 'td' and text in self.labels and text not in self.rows:
+                self.rows[text] = row[i + 1:]
+
+
+def scrapeStatusPage(page):
+    # returns the model name, Internet access status and the downstream/upstream channel rows
+    # (and their column headings) of the status page, or None if the page's layout isn't understood
+    if os.environ.get('MODEM_PARSER') != 'soup':
+        headings = {profile.get(key, MODEM_PROFILE_DEFAULT[key]) for profile in MODEM_PROFILES.values()
+                    for key in ('downstream_heading', 'upstream_heading')}
+        scraper = ModemPageScraper(headings=tuple(headings | {DOWNSTREAM_HEADING, UPSTREAM_HEADING}),
+                                   labels=(NETWORK_ACCESS_LABEL,), ids=(MODEL_NUMBER_ID,))
+        scraper.feed(page)
+        scraper.close()
+        status = {'model_name': scraper.elements.get(MODEL_NUMBER_ID)}
+        cells = scraper.rows.get(NETWORK_ACCESS_LABEL, [])
+        status['access'] = cells[0][1] if cells else None
+        profile = modemProfile(status['model_name'])
+        for key in ('downstream', 'upstream'):
+            # the first row after the heading's has the column headings, and every row after it a channel
+            rows = scraper.tables.get(profile[key + '_heading'], [])
+            status[key + '_header'] = rows[0] if rows else None
+            status[key] = rows[1:] if rows else None
+        if None not in status.values():
+            return status
+    return scrapeStatusPageWithSoup(page)
+
+
+def scrapeStatusPageWithSoup(page):
+    # the original (slow, but very forgiving) parse; used when the page defeats ModemPageScraper
+    try:
+        from bs4 import BeautifulSoup, Tag
+    except ImportError:
+        return None
+    soup = BeautifulSoup(str(page), 'html5lib')  # this call takes a long time
+
+    status = {'model_name': None}
+    model_name_tag = soup.find(id=MODEL_NUMBER_ID)
+    if model_name_tag:
+        status['model_name'] = model_name_tag.get_text()
+
+    td = soup.find('td', string=NETWORK_ACCESS_LABEL)
+    if td is None:
+        return None
+    status['access'] = td.parent()[1].get_text()
+
+    profile = modemProfile(status['model_name'])
+    for key in ('downstream', 'upstream'):
+        block = soup.find('th', string=profile[key + '_heading'])
+        if block is None:
+            return None
+        # the first row after the heading's has the column headings, whether or not there's space between
+        block = next((row for row in block.parent.next_siblings if isinstance(row, Tag)), None)
+        if block is None:
+            return None
+        status[key + '_header'] = [column.get_text() for column in block if isinstance(column, Tag)]
+        status[key] = []
+        for row in block.next_siblings:
+            if isinstance(row, Tag):
+                status[key].append([column.get_text() for column in row if isinstance(column, Tag)])
+    return status
+
 
+def scrapeUptimePage(page):
+    # returns the text of the "Up Time" value cell, or None if it can't be found
+    if os.environ.get('MODEM_PARSER') != 'soup':
+        scraper = ModemPageScraper(labels=(UPTIME_LABEL,))
+        scraper.feed(page)
+        scraper.close()
+        cells = scraper.rows.get(UPTIME_LABEL, [])
+        if cells:
+            return cells[0][1]
     try:
-        page = requests.get(url, timeout=25).text
+        from bs4 import BeautifulSoup, Tag
+    except ImportError:
+        return None
+    soup = BeautifulSoup(str(page), 'html5lib')  # this call takes a long time
+    block = soup.find('td', string=UPTIME_LABEL)
+    if block is None:
+        return None
+    block = next((cell for cell in block.next_siblings if isinstance(cell, Tag)), None)  # the cell after the label's
+    return block.get_text() if block is not None else None
+
+
+def getModemUptime(url, aReport, model_name, session=None, timeout=25):
+    import requests
+
+    try:
+        page = (session or requests).get(url, timeout=timeout).text
+        aReport.setdefault('timing', {})['uptime_bytes'] = len(page)
     except requests.exceptions.RequestException:
         print("# modem uptime page not responding", file=sys.stderr)
         return False
     # drop some nasty characters
     page = page.translate(str.maketrans('', '', "\n\x00\x09\r"))
-    soup = BeautifulSoup(str(page), 'html5lib')  # this call takes a long time
-
-    block = soup.find('td', string="Up Time")
-    block = block.next_sibling  # skip the header rows
-    block = block.next_sibling
-    uptimeText = block.get_text()
-    uptimeElements = re.findall(r"\d+", uptimeText)
+    uptimeText = scrapeUptimePage(page)
+    if uptimeText is None:
+        print("# modem uptime page not understood", file=sys.stderr)
+        return False
+    uptimeElements = re.search(modemProfile(model_name)['uptime_pattern'], uptimeText)
+    if uptimeElements is None:
+        print("# modem uptime not understood:", uptimeText, file=sys.stderr)
+        return False
     uptime_seconds = \
-        int(uptimeElements[0]) * 86400 \
-        + int(uptimeElements[1]) * 3600 \
-        + int(uptimeElements[2]) * 60 \
-        + int(uptimeElements[3])
+        int(uptimeElements.group(1)) * 86400 \
+        + int(uptimeElements.group(2)) * 3600 \
+        + int(uptimeElements.group(3)) * 60 \
+        + int(uptimeElements.group(4))
     # report as days, so divide by 86400 seconds/day
-    report['uptime_seconds'] = float(str(uptime_seconds)) / 86400.0
+    aReport['uptime_seconds'] = float(str(uptime_seconds)) / 86400.0
     return True
 
-    # expected return is that report['gateway'] and report'next_hop_latency'] exist
+    # expected return is that aReport['gateway'] and report'next_hop_latency'] exist
 
 
-def getNextHopLatency():
-    global report
-    report['gateway'] = ''
-    report['next_hop_latency'] = ''
+def getModemEventsIntoReport(url, aReport, suffix, session=None, timeout=10):
+    # count the event log's entries that are new since last time, by priority and by type
+    import requests
+
+    aReport['events'] = {}
+    try:
+        page = (session or requests).get(url, timeout=timeout).text
+        aReport.setdefault('timing', {})['eventlog_bytes'] = len(page)
+    except requests.exceptions.RequestException:
+        print("# modem event log page not responding", file=sys.stderr)
+        return False
+    # drop some nasty characters
+    page = page.translate(str.maketrans('', '', "\n\x00\x09\r"))
+    entries = scrapeEventLogPage(page)
+    if entries is None:
+        print("# modem event log page not understood", file=sys.stderr)
+        return False
+
+    mark = loadStateFile(EVENT_MARK_FILE.format(suffix))
+    newEntries, newMark = newEventsSince(entries, mark)
+    for entry in reversed(newEntries):  # oldest first, as they happened
+        appendToHistory(EVENT_LOG_FILE.format(suffix), entry, EVENT_LOG_MAX_BYTES)
+    saveStateFile(EVENT_MARK_FILE.format(suffix), newMark)
+    if not mark:  # the first look; what's there already happened some time before now
+        newEntries = []
+
+    aReport['events'] = {'types': {field: 0 for field, _, _ in EVENT_TYPES},
+                         'severity': {severity: 0 for severity in EVENT_SEVERITIES.values()}}
+    for entry in newEntries:
+        aReport['events']['types'][entry['type']] += 1
+        if entry['priority'] in EVENT_SEVERITIES:
+            aReport['events']['severity'][EVENT_SEVERITIES[entry['priority']]] += 1
+    return True
+
+
+def scrapeEventLogPage(page):
+    # returns the event log's entries as [time, priority, description] texts, or None if the
+    # page's layout isn't understood
+    scraper = ModemPageScraper(headings=(EVENTLOG_HEADING,))
+    scraper.feed(page)
+    scraper.close()
+    if EVENTLOG_HEADING not in scraper.tables:
+        return None
+    # the column headings' row has no priority number in it, so it drops out here
+    return [row for row in scraper.tables[EVENTLOG_HEADING]
+            if len(row) >= 3 and re.search(r'\(\d\)', row[1])]
+
+
+def newEventsSince(entries, mark):
+    # The entries newer than the high-water mark left last time, newest first, and the new mark.
+    # Working back from the newest entry, we can stop at the first one the mark says was seen,
+    # rather than going through the whole log every time. Entries the modem logged before it
+    # had the time can't be placed, so those are told apart by the timed entry before them and
+    # how many identical ones came before them since; the mark keeps those of the last page.
+    records = []
+    for timeText, priorityText, description in (row[:3] for row in entries):
+        record = {'time': None, 'priority': None, 'description': description.strip()}
+        for timeFormat in EVENT_TIME_FORMATS:
+            try:
+                record['time'] = time.mktime(time.strptime(timeText.strip(), timeFormat))
+                break
+            except ValueError:
+                pass
+        if record['time'] is None:
+            record['time_text'] = timeText.strip()
+        priority = re.search(r'\((\d)\)', priorityText)
+        if priority:
+            record['priority'] = int(priority.group(1))
+        record['type'] = next(field for field, _, pattern in EVENT_TYPES if re.search(pattern, description))
+        record['hash'] = '|'.join((timeText, priorityText, description))
+        records.append(record)
+    times = [record['time'] for record in records if record['time'] is not None]
+    if len(times) > 1 and times[0] < times[-1]:  # the modem lists oldest first
+        records.reverse()
+
+    # identical entries (the same time, or none and the same timed entry before them) count apart,
+    # numbered oldest first so that the ones already seen keep their numbers as more are logged
+    occurrences = {}
+    before = ''
+    for record in reversed(records):
+        key = record['hash'] if record['time'] is not None else before + '|' + record['hash']
+        occurrences[key] = occurrences.get(key, 0) + 1
+        record['hash'] = hashlib.sha1('{}|{}'.format(key, occurrences[key]).encode()).hexdigest()[:12]
+        if record['time'] is not None:
+            before = record['hash']
+
+    markTime = mark.get('time', 0)
+    markHashes = set(mark.get('hashes', []))
+    untimed = set(mark.get('untimed', []))
+    newEntries = []
+    for record in records:
+        if record['time'] is None:
+            if record['hash'] not in untimed:
+                newEntries.append(record)
+            continue
+        if record['time'] < markTime:
+            break  # and everything before it was counted already
+        if record['time'] == markTime and record['hash'] in markHashes:
+            continue
+        newEntries.append(record)
+
+    newestTime = max(times, default=markTime)
+    newHashes = {record['hash'] for record in records if record['time'] == newestTime}
+    newMark = {'time': newestTime,
+               'hashes': sorted(newHashes | markHashes if newestTime == markTime else newHashes),
+               'untimed': sorted(record['hash'] for record in records if record['time'] is None)}
+    return newEntries, newMark
+
+
+def getNextHopLatency(aReport):
+    aReport['gateway'] = ''
+    aReport['next_hop_latency'] = ''
+    if os.environ.get('LATENCY_PROBE', LATENCY_PROBE) != 'commands':
+        try:
+            stats = timed(aReport, 'ping', probeNextHop)
+        except OSError as the_error:
+            print("# built-in latency probe unavailable, using traceroute and ping:", the_error, file=sys.stderr)
+        else:
+            if stats is None:
+                return False
+            aReport['gateway'] = stats['gateway']
+            aReport['latency'] = stats
+            # clip this value's peaks to spare graph messes when something's wrong
+            aReport['next_hop_latency'] = str(min(stats['avg'], 30.0))
+            return True
+    return getNextHopLatencyWithCommands(aReport)
+
+
+def getNextHopLatencyWithCommands(aReport):
+    # that hop rarely changes, so reuse the one found on an earlier run while it's fresh enough
+    gatewayCache = loadStateFile(GATEWAY_CACHE_FILE)
+    minutes_elapsed = (time.time() - gatewayCache.get('discovered', 0)) / 60
+    if gatewayCache.get('gateway') and minutes_elapsed <= LATENCY_GATEWAY_MAX_AGE:
+        aReport['gateway'] = gatewayCache['gateway']
+        result = timed(aReport, 'ping', measureLatency, aReport['gateway'])
+        if result != '':
+            aReport['next_hop_latency'] = result
+            return True
+        # no answer from the remembered hop, so go looking for the current one
+
+    aReport['gateway'] = timed(aReport, 'trace', discoverGateway)
+    if aReport['gateway'] != '':
+        saveStateFile(GATEWAY_CACHE_FILE, {'gateway': aReport['gateway'], 'discovered': time.time()})
+    result = timed(aReport, 'ping', measureLatency, aReport['gateway'])
+    if result == '':
+        return False
+    aReport['next_hop_latency'] = result
+    return True
+
+
+def probeNextHop(host=LATENCY_GATEWAY_HOST, hops=LATENCY_GATEWAY_HOPS, count=LATENCY_PROBE_COUNT):
+    # returns the hop's address and the min/avg/max/jitter of its round trip time in ms, and
+    # the percentage of probes lost, or None if none came back
+    # the probes themselves take LATENCY_PROBE_SPACING apiece, before the wait for answers
+    spacing = count * float(os.environ.get('LATENCY_PROBE_SPACING', LATENCY_PROBE_SPACING))
+    timeout = float(os.environ.get('LATENCY_PROBE_TIMEOUT', LATENCY_PROBE_TIMEOUT))
+    import asyncio  # only here, so that 'config' needn't wait for it to load
+    return asyncio.run(probeHop(socket.gethostbyname(host), hops, count,
+                                max(0.1, timeLeft(timeout + spacing) - spacing)))
+
+
+async def probeHop(address, hops, count, timeout):
+    # Does in one process what traceroute and ping did between them, the way traceroute's UDP
+    # mode does, and with no special privileges: each probe is a datagram to an unused port of
+    # the address, sent with a TTL that runs out at the hop we want. That router's ICMP "time
+    # exceeded" (or "port unreachable", if the address itself is that close) comes back on the
+    # socket's error queue, naming the router. The error queue is Linux-only; elsewhere the
+    # setsockopt() raises OSError. Probing a closed port on 127.0.0.1 exercises all of this.
+    import asyncio
+    loop = asyncio.get_running_loop()
+    sent = {}  # port: when
+    answers = {}  # port: (round trip ms, who answered)
+    allAnswered = loop.create_future()
+
+    def readErrorQueue():
+        while True:
+            try:
+                _, ancdata, _, destination = sock.recvmsg(1, 512, socket.MSG_ERRQUEUE)
+            except (BlockingIOError, InterruptedError):
+                return
+            received = time.perf_counter()
+            port = destination[1]
+            for level, kind, data in ancdata:
+                if level != socket.IPPROTO_IP or kind != IP_RECVERR or len(data) < 24:
+                    continue
+                _, origin, icmpType = struct.unpack_from('=IBB', data)
+                # time exceeded, or destination unreachable; the sender's address follows the error
+                if origin == SO_EE_ORIGIN_ICMP and icmpType in (11, 3) and port in sent and port not in answers:
+                    answers[port] = ((received - sent[port]) * 1000, socket.inet_ntoa(data[20:24]))
+            if len(answers) == count and not allAnswered.done():
+                allAnswered.set_result(True)
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setsockopt(socket.IPPROTO_IP, IP_RECVERR, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, hops)
+        sock.setblocking(False)
+        loop.add_reader(sock.fileno(), readErrorQueue)
+        try:
+            for port in range(LATENCY_PROBE_PORT, LATENCY_PROBE_PORT + count):
+                sent[port] = time.perf_counter()
+                try:
+                    sock.sendto(b'arris.py', (address, port))
+                except (ConnectionRefusedError, OSError) as the_error:
+                    # an answer to an earlier probe, reported here too; the probe still needs sending
+                    if the_error.errno not in (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH):
+                        raise
+                    sent[port] = time.perf_counter()
+                    sock.sendto(b'arris.py', (address, port))
+                await asyncio.sleep(float(os.environ.get('LATENCY_PROBE_SPACING', LATENCY_PROBE_SPACING)))
+            try:
+                await asyncio.wait_for(allAnswered, timeout)
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            loop.remove_reader(sock.fileno())
+
+    if not answers:
+        return None
+    rtts = [answers[port][0] for port in sorted(answers)]  # in the order they were sent
+    responders = [answers[port][1] for port in sorted(answers)]
+    return {
+        'gateway': max(set(responders), key=responders.count),
+        'min': round(min(rtts), 3),
+        'avg': round(sum(rtts) / len(rtts), 3),
+        'max': round(max(rtts), 3),
+        'jitter': round(sum(abs(b - a) for a, b in zip(rtts, rtts[1:])) / max(1, len(rtts) - 1), 3),
+        'loss': round(100.0 * (count - len(rtts)) / count, 1),
+    }
+
+
+class LatencyHistogram:
+    # Counts of round trip times in log-spaced buckets, in a memory-mapped file of integers, so
+    # the sampler's second-by-second probes cost the same time and space however many there are:
+    #   probes sent, probes lost, the longest round trip (microseconds), then the buckets
+    # Each access holds a lock on the file, so a drain() can't lose a sample being added.
+
+    def __init__(self, path):
+        self.buckets = LATENCY_HISTOGRAM_DECADES * LATENCY_HISTOGRAM_STEPS
+        size = 8 * (3 + self.buckets)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            if os.fstat(self._fd).st_size != size:  # new, or made with other dimensions; start over
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._map = mmap.mmap(self._fd, size)
+        except OSError:
+            os.close(self._fd)
+            raise
+        self._counts = memoryview(self._map).cast('Q')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._counts.release()
+        self._map.close()
+        os.close(self._fd)
+
+    def add(self, rtt):
+        # one probe's round trip in ms, or None if it was lost
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            self._counts[0] += 1
+            if rtt is None:
+                self._counts[1] += 1
+                return
+            self._counts[2] = max(self._counts[2], int(rtt * 1000))
+            bucket = int(math.log10(max(rtt, LATENCY_HISTOGRAM_FLOOR) / LATENCY_HISTOGRAM_FLOOR)
+                         * LATENCY_HISTOGRAM_STEPS)
+            self._counts[3 + min(bucket, self.buckets - 1)] += 1
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def drain(self):
+        # percentiles and loss since the last drain, which starts the next interval afresh
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            probes, lost, longest = self._counts[0], self._counts[1], self._counts[2]
+            counts = self._counts[3:].tolist()
+            self._counts[0:len(self._counts)] = array('Q', bytes(8 * len(self._counts)))
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        if not probes:
+            return {}
+        summary = {'samples': probes, 'loss': round(100.0 * lost / probes, 1)}
+        answered = probes - lost
+        if answered:
+            summary['max'] = longest / 1000
+            for name, fraction in (('p50', 0.50), ('p95', 0.95), ('p99', 0.99)):
+                wanted = math.ceil(answered * fraction)
+                seen = 0
+                for bucket, count in enumerate(counts):
+                    seen += count
+                    if seen >= wanted:
+                        break
+                # the middle of the bucket (geometrically), but no more than the longest seen
+                summary[name] = round(min(LATENCY_HISTOGRAM_FLOOR * 10 ** ((bucket + 0.5) / LATENCY_HISTOGRAM_STEPS),
+                                          summary['max']), 3)
+        return summary
+
+
+def runLatencySampler():
+    # Probe the next hop every LATENCY_SAMPLE_INTERVAL seconds, adding each result to the histogram
+    # that the next scrape reports and resets. Runs until killed.
+    interval = float(os.environ.get('LATENCY_SAMPLE_INTERVAL', LATENCY_SAMPLE_INTERVAL))
+    address = socket.gethostbyname(LATENCY_GATEWAY_HOST)
+    import asyncio
+    with LatencyHistogram(stateFilePath(LATENCY_HISTOGRAM_FILE)) as histogram:
+        while True:
+            started = time.time()
+            stats = asyncio.run(probeHop(address, LATENCY_GATEWAY_HOPS, 1, interval / 2))
+            histogram.add(stats['avg'] if stats else None)
+            time.sleep(max(0, interval - (time.time() - started)))
+
+
+def discoverGateway():
     # issue the command to discover the gateway at the designated hop distance
     cmd = LATENCY_GATEWAY_CMD \
         + str(LATENCY_GATEWAY_HOPS) \
         + " " \
         + LATENCY_GATEWAY_HOST
     try:
-        output = subprocess.run(cmd.split(' '), capture_output=True)
-    except subprocess.CalledProcessError:
-        return False
+        output = subprocess.run(cmd.split(' '), capture_output=True, timeout=timeLeft())
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        return ''
     # parse the results for the IP addr of that hop
     result = ''
     for line in output.stdout.decode("utf-8").split('\n'):
@@ -475,13 +2060,16 @@ def getNextHopLatency():
             if len(result) > 3:
                 result = result[3]
             break
-    report['gateway'] = str(result)
+    return str(result)
+
+
+def measureLatency(gateway):
     # issue the command to measure latency to that hop
-    cmd = LATENCY_MEASURE_CMD + report['gateway']  # + " 2>/dev/null"
+    cmd = LATENCY_MEASURE_CMD + gateway  # + " 2>/dev/null"
     try:
-        output = result = subprocess.run(cmd.split(' '), capture_output=True)
-    except subprocess.CalledProcessError:
-        return False
+        output = subprocess.run(cmd.split(' '), capture_output=True, timeout=timeLeft())
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+        return ''
     # parse the results for the 4th field which is the average delay
     result = ''
     for line in output.stdout.decode("utf-8").split('\n'):
@@ -496,36 +2084,37 @@ def getNextHopLatency():
             result = str(30.0)
     except ValueError:
         result = ''
-    if result == '':
-        return False
-    report['next_hop_latency'] = str(result)
-    return True
+    return str(result)
 
 
 def checkSpeedtestData(args):
-    global SPEEDTEST_JSON_FILE
+    result = loadSpeedtestHistoryIntoReport()
+    # the last test (or its failure) decided when the next one is due
+    if time.time() >= loadStateFile(SPEEDTEST_SCHEDULE_FILE).get('next_due', 0):
+        queueSpeedTest(args)
+    return result
 
-    try: # Use the munin-supplied folder location, or default for standalone
-        SPEEDTEST_JSON_FILE = os.environ['MUNIN_PLUGSTATE'] + '/' + SPEEDTEST_JSON_FILE
-    except KeyError:
-        SPEEDTEST_JSON_FILE = STATEFUL_FILE_DIR_DEFAULT + '/' + SPEEDTEST_JSON_FILE
 
-    result = loadSpeedtestFileIntoReport(SPEEDTEST_JSON_FILE)
-    currentTime = datetime.datetime.utcnow()
+def loadSpeedtestHistoryIntoReport():
+    # the latest test, and the medians of the recent ones on the same server, from the end of the log
+    global report
+    report['speedtest'] = {}
+    report.pop('speedtest_medians', None)
+    records = readHistoryTail(stateFilePath(SPEEDTEST_HISTORY_FILE), SPEEDTEST_HISTORY_WINDOW)
+    if not records:  # none logged yet, but there may be a result from before the log
+        return loadSpeedtestFileIntoReport(stateFilePath(SPEEDTEST_JSON_FILE))
+    report['speedtest'].update(records[-1])
+    server = records[-1].get('server', {}).get('id')
+    sameServer = [record for record in records if record.get('server', {}).get('id') == server]
     try:
-        priorTime = datetime.datetime.fromisoformat(report['speedtest']['timestamp'][:-1])
-        minutes_elapsed = (currentTime - priorTime) / datetime.timedelta(minutes=1)
-    except KeyError:
-        minutes_elapsed = SPEEDTEST_MAX_AGE + 1
-    # if it's too old, empty, or recorded a slow test, generate a new one
-    # TODO try logic here that retests sooner based on percentage below ideal speed
-    if minutes_elapsed > SPEEDTEST_MAX_AGE or \
-        ((float(report['speedtest']['download']) < SPEEDTEST_RETEST_DOWNLOAD
-          or float(report['speedtest']['upload']) < SPEEDTEST_RETEST_UPLOAD)
-          and minutes_elapsed > 9):  # wait ~10 minutes to retest, so the graph can better show the hiccup
-        # minutes_elapsed > ((float(report['speedtest']['download']) / SPEEDTEST_IDEAL_DOWNLOAD * SPEEDTEST_MAX_AGE) \
-        queueSpeedTest(SPEEDTEST_JSON_FILE, SPEEDTEST_CMD, args)
-    return result
+        report['speedtest_medians'] = {
+            'download': statistics.median(record['download'] for record in sameServer) / 1000000,
+            'upload': statistics.median(record['upload'] for record in sameServer) / 1000000,
+            'tests': len(sameServer),
+        }
+    except (KeyError, TypeError):
+        pass
+    return True
 
 
 def loadSpeedtestFileIntoReport(aFile):
@@ -541,22 +2130,304 @@ def loadSpeedtestFileIntoReport(aFile):
         return False
 
 
-def queueSpeedTest(output_json_file, speedtest_cmd, args):
-    # theCmd = 'echo "'+speedtest_cmd+' > ' + output_json_file + '" | at now + 2 minutes 2>/dev/null'
-    theCmd = 'nohup /bin/sh -c "sleep 75 ; '+speedtest_cmd+' > '+output_json_file+'" >/dev/null 2>&1 &'
-    if not 'nospeedtest' in args:  # for testing this code w/o running an actual speedtest
+def readHistoryTail(path, count):
+    # The last count records of a JSON-lines log (carrying on into its rotated '.1' if need be),
+    # oldest first. Read backwards from the end in blocks, so a long log costs no more than a short one.
+    records = []
+    for aPath in (path, path + '.1'):
         try:
-            result = subprocess.run(theCmd, shell=True)
-            return result.returncode == 0  # return a boolean
-        except subprocess.CalledProcessError:
-            print("# error running", '"', theCmd, '"', the_error, file=sys.stderr)
+            with open(aPath, 'rb') as fhInput:
+                position = fhInput.seek(0, os.SEEK_END)
+                data = b''
+                while position > 0 and data.count(b'\n') <= count - len(records):
+                    step = min(4096, position)
+                    position -= step
+                    fhInput.seek(position)
+                    data = fhInput.read(step) + data
+        except (FileNotFoundError, OSError, PermissionError):
+            continue
+        lines = data.split(b'\n')
+        if position > 0:
+            lines = lines[1:]  # that one's only partly read
+        older = []
+        for line in lines:
+            try:
+                older.append(json.loads(line))
+            except ValueError:  # blank, or cut short
+                pass
+        records = older[-(count - len(records)):] + records
+        if len(records) >= count:
+            break
+    return records
+
+
+def appendToHistory(name, record, maxBytes=SPEEDTEST_HISTORY_MAX_BYTES):
+    # one line per record, rotating the log once it's grown past its limit
+    path = stateFilePath(name)
+    try:
+        if os.path.getsize(path) > maxBytes:
+            os.replace(path, path + '.1')
+    except FileNotFoundError:
+        pass
+    try:
+        with open(path, 'a') as fhOutput:
+            fhOutput.write(json.dumps(record, separators=(',', ':')) + '\n')
+        return True
+    except (OSError, PermissionError) as the_error:
+        print("# error writing", path, the_error, file=sys.stderr)
+        return False
+
+
+def queueSpeedTest(args):
+    # Start 'arris.py speedtest' in the background, unless one is already queued or running.
+    # It inherits our hold on the lock file, which then lasts until its test is done.
+    theCmd = [sys.executable, os.path.abspath(__file__), 'speedtest']
+    if 'nospeedtest' in args:  # for testing this code w/o running an actual speedtest
+        print('# would have run:', ' '.join(theCmd), file=sys.stderr)
+        return False
+    lockFile = open(stateFilePath(SPEEDTEST_LOCK_FILE), 'a')
+    try:
+        fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        proc = subprocess.Popen(theCmd, pass_fds=(lockFile.fileno(),), start_new_session=True,
+                                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        lockFile.truncate(0)
+        lockFile.write(str(proc.pid))  # for the curious
+        return True
+    except BlockingIOError:  # there's one underway already
+        return False
+    except OSError as the_error:
+        print("# error running", '"', ' '.join(theCmd), '"', the_error, file=sys.stderr)
+        return False
+    finally:
+        lockFile.close()
+
+
+def runSpeedTest(args):
+    # the background half of queueSpeedTest(); waits for munin's fetch to be well out of the way first
+    time.sleep(SPEEDTEST_DELAY)
+    schedule = loadStateFile(SPEEDTEST_SCHEDULE_FILE)
+    try:
+        output = subprocess.run(SPEEDTEST_CMD.split(' '), capture_output=True, timeout=300)
+        result = json.loads(output.stdout)
+        download = float(result['download'])
+        upload = float(result['upload'])
+    except (OSError, subprocess.SubprocessError, ValueError, KeyError, TypeError) as the_error:
+        print("# error running", SPEEDTEST_CMD, the_error, file=sys.stderr)
+        # back off, so a broken speedtest-cli or an outage doesn't have us retrying every run
+        schedule['failures'] = schedule.get('failures', 0) + 1
+        minutes = min(SPEEDTEST_RETEST_MINIMUM * 2 ** (schedule['failures'] - 1), SPEEDTEST_MAX_BACKOFF)
     else:
-        print('# would have run:', theCmd, file=sys.stderr)
-    return False
+        server = result.get('server', {})
+        appendToHistory(SPEEDTEST_HISTORY_FILE, {  # just what the graph and its medians need
+            'timestamp': result.get('timestamp'), 'download': download, 'upload': upload, 'ping': result.get('ping'),
+            'server': {'id': server.get('id'), 'sponsor': server.get('sponsor'), 'd': server.get('d')}})
+        schedule['failures'] = 0
+        minutes = nextSpeedTestDelay(download, upload, schedule)
+    schedule['next_due'] = time.time() + minutes * 60
+    saveStateFile(SPEEDTEST_SCHEDULE_FILE, schedule)
+    return schedule['failures'] == 0
+
+
+def nextSpeedTestDelay(download, upload, schedule):
+    # minutes until the next test: the further the result fell below the expected speed,
+    # the sooner we look again, but a slowdown that persists has us backing off toward
+    # the usual SPEEDTEST_MAX_AGE
+    if download >= SPEEDTEST_RETEST_DOWNLOAD and upload >= SPEEDTEST_RETEST_UPLOAD:
+        schedule['slow_runs'] = 0
+        return SPEEDTEST_MAX_AGE
+    schedule['slow_runs'] = schedule.get('slow_runs', 0) + 1
+    shortfall = max(1 - download / (SPEEDTEST_EXPECTED_DOWNLOAD * 1000000),
+                    1 - upload / (SPEEDTEST_EXPECTED_UPLOAD * 1000000), 0)
+    # wait at least ~10 minutes to retest, so the graph can better show the hiccup
+    minutes = max(SPEEDTEST_MAX_AGE * (1 - shortfall), SPEEDTEST_RETEST_MINIMUM)
+    return min(minutes * 2 ** (schedule['slow_runs'] - 1), SPEEDTEST_MAX_AGE)
+
+
+class SampleRing:
+    # A fixed-size ring of timestamped per-channel samples, in a memory-mapped file of doubles:
+    #   header - the next slot, the number of samples held, then the down and up channel keys
+    #   slot   - the time, then power/snr/freq/corrected/uncorrectable for each down channel
+    #            and power/freq for each up channel (NaN where there's no such channel)
+    # A new channel line-up starts the ring over, since the old samples' columns no longer match.
+    DOWN_FIELDS = ('downpower', 'downsnr', 'downfreq', 'corrected_total', 'uncorrectable_total')
+    UP_FIELDS = ('uppower', 'upfreq')
+
+    def __init__(self, path, slots=SAMPLE_RING_SLOTS,
+                 downChannels=SAMPLE_RING_DOWN_CHANNELS, upChannels=SAMPLE_RING_UP_CHANNELS):
+        self.slots = slots
+        self.downChannels = downChannels
+        self.upChannels = upChannels
+        self.headerSize = 2 + downChannels + upChannels
+        self.recordSize = 1 + downChannels * len(self.DOWN_FIELDS) + upChannels * len(self.UP_FIELDS)
+        size = 8 * (self.headerSize + slots * self.recordSize)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != size:  # new, or made with other dimensions; start over
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._doubles = memoryview(self._map).cast('d')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._doubles.release()
+        self._map.close()
+
+    def keys(self):
+        header = self._doubles[2:self.headerSize]
+        return header[:self.downChannels].tolist(), header[self.downChannels:].tolist()
+
+    def append(self, aReport, timestamp):
+        downKeys = list(aReport['downchan_id'])
+        upKeys = list(aReport['upchan_id'])
+        for keys, room, direction in ((downKeys, self.downChannels, 'down'), (upKeys, self.upChannels, 'up')):
+            if len(keys) > room:
+                print('# sample ring has room for {} {}stream channels; leaving out {}'.format(
+                    room, direction, ', '.join(keys[room:])), file=sys.stderr)
+                del keys[room:]
+        header = array('d', [float(key) for key in downKeys] + [-1.0] * (self.downChannels - len(downKeys))
+                       + [float(key) for key in upKeys] + [-1.0] * (self.upChannels - len(upKeys)))
+        if self._doubles[2:self.headerSize].tolist() != header.tolist():
+            self._doubles[0] = 0  # next slot
+            self._doubles[1] = 0  # samples held
+            self._doubles[2:self.headerSize] = header
+
+        record = array('d', [math.nan]) * self.recordSize
+        record[0] = timestamp
+        for keys, fields, offset, width in ((downKeys, self.DOWN_FIELDS, 1, self.downChannels),
+                                            (upKeys, self.UP_FIELDS, 1 + self.downChannels * len(self.DOWN_FIELDS),
+                                             self.upChannels)):
+            for f, field in enumerate(fields):
+                for i, key in enumerate(keys):
+                    try:
+                        record[offset + f * width + i] = float(aReport[field][key])
+                    except (KeyError, ValueError):
+                        pass
+        slot = int(self._doubles[0])
+        start = self.headerSize + slot * self.recordSize
+        self._doubles[start:start + self.recordSize] = record
+        self._doubles[0] = (slot + 1) % self.slots
+        self._doubles[1] = min(int(self._doubles[1]) + 1, self.slots)
+
+    def latest(self, count):
+        # the newest samples, oldest first
+        held = int(self._doubles[1])
+        newest = int(self._doubles[0]) - 1
+        records = []
+        for back in reversed(range(min(count, held))):
+            start = self.headerSize + ((newest - back) % self.slots) * self.recordSize
+            records.append(self._doubles[start:start + self.recordSize])
+        return records
+
+    def column(self, record, field):
+        # one field's values across the channels present in a record
+        if field in self.DOWN_FIELDS:
+            start = 1 + self.DOWN_FIELDS.index(field) * self.downChannels
+            values = record[start:start + self.downChannels]
+        else:
+            start = 1 + self.downChannels * len(self.DOWN_FIELDS) + self.UP_FIELDS.index(field) * self.upChannels
+            values = record[start:start + self.upChannels]
+        return [value for value in values.tolist() if not math.isnan(value)]
+
+    def errorRates(self):
+        # per-minute corrected/uncorrectable blocks for each down channel over the last interval.
+        # The counters only climb until the modem restarts, so if any went backwards they all
+        # started over from zero, and what they show now is all that's happened since.
+        downKeys = self.keys()[0]
+        samples = self.latest(2)
+        if len(samples) < 2 or samples[1][0] <= samples[0][0]:
+            return {}, {}
+        previous, current = samples
+        minutes = (current[0] - previous[0]) / 60
+        rates = []
+        for field in ('corrected_total', 'uncorrectable_total'):
+            start = 1 + self.DOWN_FIELDS.index(field) * self.downChannels
+            rates.append([(current[start + i], current[start + i] - previous[start + i])
+                          for i in range(self.downChannels)])
+        restarted = any(delta < 0 for fieldRates in rates for _, delta in fieldRates)
+        result = []
+        for fieldRates in rates:
+            result.append({'{:g}'.format(downKeys[i]): (value if restarted else delta) / minutes
+                           for i, (value, delta) in enumerate(fieldRates)
+                           if downKeys[i] >= 0 and not math.isnan(delta)})
+        return result[0], result[1]
+
+    def rollingStats(self, count):
+        # min/max/mean/95th percentile of each spread over the last count samples
+        spreads = {'downpowerspread': [], 'downsnrspread': [], 'uppowerspread': []}
+        for record in self.latest(count):
+            for spread, field in (('downpowerspread', 'downpower'), ('downsnrspread', 'downsnr'),
+                                  ('uppowerspread', 'uppower')):
+                values = self.column(record, field)
+                if values:
+                    spreads[spread].append(max(values) - min(values))
+        stats = {}
+        for spread, values in spreads.items():
+            if values:
+                values.sort()
+                stats[spread] = {'min': values[0], 'max': values[-1], 'mean': sum(values) / len(values),
+                                 'p95': values[min(len(values) - 1, int(len(values) * 0.95))]}
+        return stats
+
+
+def recordSamples(aReport, ringFile):
+    # file the new sample away, then work out the error rates and rolling spreads from the history
+    try:
+        with SampleRing(stateFilePath(ringFile)) as ring:
+            ring.append(aReport, time.time())
+            aReport['corrected_rate'], aReport['uncorrectable_rate'] = ring.errorRates()
+            aReport['spread_stats'] = ring.rollingStats(SPREAD_WINDOW)
+    except (OSError, ValueError) as the_error:
+        print("# error updating", ringFile, the_error, file=sys.stderr)
+
+
+def timed(aReport, stage, func, *args):
+    # call func, adding the milliseconds it took to the report's timings for that stage
+    started = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        timing = aReport.setdefault('timing', {})
+        timing[stage] = round(timing.get(stage, 0) + (time.perf_counter() - started) * 1000, 1)
+
+
+def stateFilePath(name):
+    # Use the munin-supplied folder location, or default for standalone
+    return os.path.join(os.environ.get('MUNIN_PLUGSTATE', STATEFUL_FILE_DIR_DEFAULT), name)
+
+
+def loadStateFile(name):
+    # a missing or damaged state file just means we start over
+    try:
+        with open(stateFilePath(name), 'r') as fhInput:
+            return json.load(fhInput)
+    except (FileNotFoundError, OSError, PermissionError, json.decoder.JSONDecodeError):
+        return {}
+
+
+def saveStateFile(name, data):
+    # write-then-rename, so a reader (or another run of this plugin) never sees a half-written file
+    path = stateFilePath(name)
+    try:
+        fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path), prefix=name + '.')
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'w') as fhOutput:
+            json.dump(data, fhOutput, separators=(',', ':'))
+        os.replace(tmpPath, path)
+        return True
+    except (OSError, PermissionError) as the_error:
+        print("# error writing", path, the_error, file=sys.stderr)
+        return False
 
 
 if __name__ == '__main__':
-    import sys
     try:
         resultMain = main(sys.argv)
     except (FileNotFoundError, OSError, json.decoder.JSONDecodeError) as the_error:
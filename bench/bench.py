@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+    Offline benchmarks for arris.py, driven by the captured pages and command output in fixtures/
+
+    Times (median of --repeat runs) and measures the peak memory of each stage of a scrape, for
+    each model, then whole main() runs for 'config', fetch and dirtyconfig. The modem is stood in
+    for by a local web server serving the fixtures, and traceroute/ping by their recorded output.
+    The built-in latency prober is checked, and timed, against 127.0.0.1, and the streaming page
+    parser checked against the html5lib one, which must make the same report of each page.
+    (Without the 'requests' package, main() runs read the status page from a file instead, as
+    launch.sh does, which skips the uptime page and the latency probe.)
+
+    bench.py            print the figures, and how they compare with baseline.json
+    bench.py --save     ... and make them the new baseline.json
+    bench.py --before 6533e07 --save
+                        ... and time the status page scrape of arris.py as it was at that commit
+                        (there, the html5lib parse the streaming one replaced), kept in
+                        baseline.json alongside
+"""
+
+import argparse
+import contextlib
+import functools
+import http.server
+import importlib.util
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from unittest import mock
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(BENCH_DIR, 'fixtures')
+BASELINE_FILE = os.path.join(BENCH_DIR, 'baseline.json')
+MODELS = ('sb6183', 'sb8200')
+MODEM_PAGES = {'/RgSwInfo.asp': 'sb6183_uptime.html', '/cmswinfo.html': 'sb8200_uptime.html',
+               '/RgEventLog.asp': 'sb6183_eventlog.html', '/cmeventlog.html': 'sb8200_eventlog.html'}
+
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import arris  # noqa: E402
+
+
+def measure(func, repeat):
+    # median and best wall-clock ms over repeat calls, then the peak memory of one more call
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - started) * 1000)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'median_ms': statistics.median(times), 'best_ms': min(times), 'peak_kb': peak / 1024}
+
+
+def fixture(name):
+    return os.path.join(FIXTURE_DIR, name)
+
+
+def quietly(func, *args, **kwargs):
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        return func(*args, **kwargs)
+
+
+def stageBenchmarks(model, repeat):
+    stateDir = tempfile.mkdtemp(prefix='arris-bench-')  # for the remembered column maps
+    saved = dict(os.environ)
+    os.environ['MUNIN_PLUGSTATE'] = stateDir
+    try:
+        return stageBenchmarksIn(model, repeat)
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+        shutil.rmtree(stateDir)
+
+
+def checkParsersAgree(model):
+    # the streaming parser has to make the same report of the pages as the html5lib one it replaced
+    try:
+        import bs4  # noqa: F401
+        import html5lib  # noqa: F401
+    except ImportError:
+        print('parser check skipped: no bs4/html5lib')
+        return
+    statusFile = fixture(model + '_status.html')
+    uptimePage = open(fixture(model + '_uptime.html'), 'r').read().translate(str.maketrans('', '', "\n\x00\x09\r"))
+    made = []
+    for parser in ('', 'soup'):
+        os.environ['MODEM_PARSER'] = parser
+        aReport = {}
+        arris.getStatusIntoReport(statusFile, aReport)
+        aReport.pop('timing', None)  # how long each took is bound to differ
+        made.append((aReport, arris.scrapeUptimePage(uptimePage)))
+    del os.environ['MODEM_PARSER']
+    if made[0] != made[1]:
+        sys.exit('{}: the parsers disagree'.format(model))
+
+
+def stageBenchmarksIn(model, repeat):
+    checkParsersAgree(model)
+    statusFile = fixture(model + '_status.html')
+    rawPage = open(statusFile, 'r').read()
+    page = rawPage.translate(str.maketrans('', '', "\n\x00\x09\r"))
+    status = arris.scrapeStatusPage(page)
+    aReport = {}
+    arris.getStatusIntoReport(statusFile, aReport)
+    aReport.update({'uptime_seconds': 12.5, 'next_hop_latency': '10.217',
+                    'speedtest': json.load(open(fixture('speedtest.json'), 'r'))})
+    uptimePage = open(fixture(model + '_uptime.html'), 'r').read().translate(str.maketrans('', '', "\n\x00\x09\r"))
+    eventLogPage = open(fixture(model + '_eventlog.html'), 'r').read().translate(str.maketrans('', '', "\n\x00\x09\r"))
+    events = arris.scrapeEventLogPage(eventLogPage)
+    _, eventMark = arris.newEventsSince(events[:-1], {})
+    columns = arris.statusColumns(status, aReport['model_name'])
+
+    def read():
+        with open(statusFile, 'r') as fh:
+            fh.read()
+
+    def extract():
+        emptyReport = {key: {} for key in ('downchan_id', 'downpower', 'downsnr', 'downfreq', 'corrected_total',
+                                           'uncorrectable_total', 'upchan_id', 'uppower', 'upfreq')}
+        arris.extractChannelsIntoReport(status, columns, emptyReport)
+
+    stages = {
+        'read': read,
+        'translate': lambda: rawPage.translate(str.maketrans('', '', "\n\x00\x09\r")),
+        'parse': lambda: arris.scrapeStatusPage(page),
+        'columns': lambda: arris.statusColumns(status, aReport['model_name']),
+        'extract': extract,
+        'status_scrape': lambda: arris.getStatusIntoReport(statusFile, {}),  # read to spreads, as --before times
+        'spread': lambda: arris.computeSpreadsIntoReport(dict(aReport)),
+        'uptime_parse': lambda: arris.scrapeUptimePage(uptimePage),
+        'eventlog_parse': lambda: arris.scrapeEventLogPage(eventLogPage),
+        'eventlog_new': lambda: arris.newEventsSince(events, eventMark),
+        'emit_config': lambda: quietly(arris.printReport, ['arris.py', 'config'], False, aReport),
+        'emit_fetch': lambda: quietly(arris.printReport, ['arris.py'], False, aReport),
+    }
+    return {model + '.' + name: measure(func, repeat) for name, func in stages.items()}
+
+
+class FixtureHandler(http.server.BaseHTTPRequestHandler):
+    # the status page at '/', and each model's uptime and event log pages at their own URLs
+    def __init__(self, *args, model, **kwargs):
+        self.model = model
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        name = self.model + '_status.html' if self.path == '/' else MODEM_PAGES.get(self.path)
+        if name is None:
+            self.send_error(404)
+            return
+        body = open(fixture(name), 'rb').read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def recordedRun(cmd, **kwargs):
+    # traceroute and ping, as they answered once upon a time
+    name = 'traceroute.txt' if 'traceroute' in cmd[0] else 'ping.txt'
+    return subprocess.CompletedProcess(cmd, 0, open(fixture(name), 'rb').read(), b'')
+
+
+def mainBenchmarks(model, repeat):
+    try:
+        import requests  # noqa: F401
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(FixtureHandler, model=model))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        host = '127.0.0.1:' + str(server.server_port)
+        statusUrl = 'http://' + host + '/'
+        mode = 'http'
+    except ImportError:
+        server = None
+        host = arris.MODEM_HOST
+        statusUrl = fixture(model + '_status.html')
+        mode = 'file'
+
+    stateDir = tempfile.mkdtemp(prefix='arris-bench-')
+    shutil.copy(fixture('speedtest.json'), stateDir)
+    saved = dict(os.environ), arris.MODEM_HOST
+    os.environ.update({'MUNIN_PLUGSTATE': stateDir, 'MODEM_STATUS_URL': statusUrl, 'REPORT_CACHE_TTL': '0',
+                       'LATENCY_PROBE': 'commands'})  # so the latency probe answers from the recordings
+    os.environ.pop('MUNIN_CAP_DIRTYCONFIG', None)
+    arris.MODEM_HOST = host
+    runs = {
+        'fetch': ({}, ['arris.py', 'nospeedtest']),
+        'config': ({}, ['arris.py', 'config', 'nospeedtest']),
+        'dirtyconfig': ({'MUNIN_CAP_DIRTYCONFIG': '1'}, ['arris.py', 'config', 'nospeedtest']),
+    }
+    results = {}
+    try:
+        with mock.patch('subprocess.run', recordedRun):
+            for name, (env, args) in runs.items():
+                os.environ.update(env)
+                results[model + '.main_' + name + '_' + mode] = measure(lambda: quietly(arris.main, args), repeat)
+                for key in env:
+                    del os.environ[key]
+    finally:
+        os.environ.clear()
+        os.environ.update(saved[0])
+        arris.MODEM_HOST = saved[1]
+        shutil.rmtree(stateDir)
+        if server:
+            server.shutdown()
+    return results
+
+
+def probeBenchmarks(repeat):
+    # the built-in latency prober against 127.0.0.1, where each probe's "port unreachable" comes
+    # back from the loopback interface; a check that it still works as well as a timing
+    import asyncio
+    saved = os.environ.get('LATENCY_PROBE_SPACING')
+    os.environ['LATENCY_PROBE_SPACING'] = '0.01'  # not a real link, so no need to spread them out
+    try:
+        stats = asyncio.run(arris.probeHop('127.0.0.1', 2, 5, 1.0))
+        if not stats or stats['gateway'] != '127.0.0.1' or stats['loss']:
+            sys.exit('loopback probe failed: {}'.format(stats))
+        return {'probe_loopback': measure(lambda: asyncio.run(arris.probeHop('127.0.0.1', 2, 5, 1.0)), repeat)}
+    except OSError as the_error:  # the socket error queue is Linux-only
+        print('loopback probe skipped:', the_error)
+        return {}
+    finally:
+        if saved is None:
+            del os.environ['LATENCY_PROBE_SPACING']
+        else:
+            os.environ['LATENCY_PROBE_SPACING'] = saved
+
+
+def beforeBenchmarks(rev, repeat):
+    # The status page scrape of arris.py as it was at rev, for each model. Before the stages were
+    # split out, getStatusIntoReport() read, parsed and extracted the page and worked out the
+    # spreads in one, for a file path in the module's MODEM_STATUS_URL, into its global report.
+    source = subprocess.run(['git', 'show', rev + ':arris.py'], cwd=os.path.dirname(BENCH_DIR),
+                            capture_output=True, check=True).stdout
+    sourceDir = tempfile.mkdtemp(prefix='arris-bench-')
+    try:
+        path = os.path.join(sourceDir, 'arris_before.py')
+        with open(path, 'wb') as fh:
+            fh.write(source)
+        spec = importlib.util.spec_from_file_location('arris_before', path)
+        before = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(before)
+    finally:
+        shutil.rmtree(sourceDir)
+    results = {}
+    for model in MODELS:
+        statusFile = fixture(model + '_status.html')
+        before.MODEM_STATUS_URL = statusFile
+        before.report = {}
+        if not quietly(before.getStatusIntoReport, statusFile):
+            sys.exit('{} at {} failed to scrape {}'.format('arris.py', rev, statusFile))
+        results[model + '.status_scrape'] = measure(lambda: quietly(before.getStatusIntoReport, statusFile), repeat)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks for arris.py')
+    parser.add_argument('--repeat', type=int, default=50, help='runs per stage (default 50)')
+    parser.add_argument('--main-repeat', type=int, default=10, help='runs per main() mode (default 10)')
+    parser.add_argument('--save', action='store_true', help='save the results as the new baseline')
+    parser.add_argument('--before', metavar='REV', help='also time the status page scrape of arris.py at this commit')
+    options = parser.parse_args()
+
+    results = {}
+    for model in MODELS:
+        results.update(stageBenchmarks(model, options.repeat))
+        results.update(mainBenchmarks(model, options.main_repeat))
+    results.update(probeBenchmarks(options.main_repeat))
+
+    try:
+        with open(BASELINE_FILE, 'r') as fh:
+            saved = json.load(fh)
+        baseline = saved['results']
+    except (FileNotFoundError, json.decoder.JSONDecodeError, KeyError):
+        saved, baseline = {}, {}
+    before = saved.get('before')
+    if options.before:
+        before = {'rev': options.before, 'results': beforeBenchmarks(options.before, options.repeat)}
+
+    print('{:34} {:>10} {:>10} {:>10} {:>10}'.format('stage', 'median ms', 'best ms', 'peak kB', 'vs base'))
+    for name, figures in results.items():
+        versus = ''
+        if baseline.get(name, {}).get('median_ms'):
+            versus = '{:.2f}x'.format(figures['median_ms'] / baseline[name]['median_ms'])
+        print('{:34} {:10.3f} {:10.3f} {:10.1f} {:>10}'.format(
+            name, figures['median_ms'], figures['best_ms'], figures['peak_kb'], versus))
+    if before:
+        print('\nas of', before['rev'], '(vs now)')
+        for name, figures in before['results'].items():
+            versus = ''
+            if results.get(name, {}).get('median_ms'):
+                versus = '{:.2f}x'.format(figures['median_ms'] / results[name]['median_ms'])
+            print('{:34} {:10.3f} {:10.3f} {:10.1f} {:>10}'.format(
+                name, figures['median_ms'], figures['best_ms'], figures['peak_kb'], versus))
+
+    if options.save:
+        saving = {'python': sys.version.split()[0], 'saved': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}
+        if before:
+            saving['before'] = before
+        with open(BASELINE_FILE, 'w') as fh:
+            json.dump(saving, fh, indent=1, sort_keys=True)
+        print('saved as', BASELINE_FILE)
+
+
+if __name__ == '__main__':
+    main()
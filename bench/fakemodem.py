@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+    A stand-in for one or more Arris modems, serving the captured pages in fixtures/, with faults
+
+    Each virtual modem is a web server on its own port, answering '/' with its model's status page
+    and the uptime and event log pages at the names arris.MODEM_PROFILES gives them. Any request can
+    be made to go wrong, at random, in the ways real modems do: answer slowly, stop short, send junk,
+    leave out a table, say the Internet connection isn't allowed, or drop the connection outright.
+
+    fakemodem.py                                one SB6183 on 127.0.0.1:8183
+    fakemodem.py --models sb6183,sb8200 --count 20 --port 9000 --latency 0.5 --reset 0.05
+                                                20 modems, alternating models, on ports 9000-9019
+
+    Point the plugin at one with MODEM_STATUS_URL=http://127.0.0.1:8183/ (its other pages are asked
+    for from the same host), or at many with MODEM_HOSTS; loadtest.py starts them itself.
+"""
+
+import argparse
+import functools
+import http.server
+import os
+import random
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(BENCH_DIR, 'fixtures')
+MODELS = ('sb6183', 'sb8200')
+FAULTS = ('truncate', 'garble', 'missing_table', 'no_access', 'reset')
+
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import arris  # noqa: E402
+
+
+class Faults:
+    # how often each fault happens (0 to 1, per request), and how slowly pages are answered
+    def __init__(self, latency=0.0, jitter=0.0, seed=None, **chances):
+        self.latency = latency
+        self.jitter = jitter
+        self.chances = {fault: float(chances.get(fault) or 0) for fault in FAULTS}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()  # random.Random isn't safe to share between the server's threads
+        self.counts = dict.fromkeys(FAULTS + ('requests',), 0)
+
+    def pick(self):
+        # the faults for one request
+        with self.lock:
+            self.counts['requests'] += 1
+            picked = {fault for fault, chance in self.chances.items() if self.random.random() < chance}
+            for fault in picked:
+                self.counts[fault] += 1
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            return picked, delay, self.random.random()
+
+
+def damaged(body, faults, roll):
+    # the page as a faulty modem might send it; roll (0 to 1) decides where the damage goes
+    if 'no_access' in faults:
+        body = body.replace(b'Allowed', b'Denied')
+    if 'missing_table' in faults:
+        heading = (arris.DOWNSTREAM_HEADING, arris.UPSTREAM_HEADING)[roll < 0.5].encode()
+        body = re.sub(rb'<table[^>]*>(?:(?!<table).)*?' + heading + rb'.*?</table>', b'', body, flags=re.S)
+    if 'garble' in faults:
+        start = int(len(body) * roll)
+        junk = bytes((b * 7 + 13) % 256 for b in body[start:start + 256])
+        body = body[:start] + junk + body[start + 256:]
+    if 'truncate' in faults:
+        body = body[:int(len(body) * roll)]
+    return body
+
+
+class FakeModemHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, as the plugin's fleet mode expects of a modem
+
+    def __init__(self, *args, pages, faults, **kwargs):
+        self.pages = pages
+        self.faults = faults
+        super().__init__(*args, **kwargs)
+
+    def do_GET(self):
+        body = self.pages.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        faults, delay, roll = self.faults.pick()
+        time.sleep(delay)
+        if 'reset' in faults:
+            # close with SO_LINGER 0, so the plugin sees a connection reset rather than a clean end
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+            self.close_connection = True
+            return
+        body = damaged(body, faults, roll)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def modemPages(model):
+    # the URL paths a modem of this model answers, and their pages
+    profile = arris.modemProfile(model.upper())
+    pages = {'/': model + '_status.html', '/' + profile['uptime_page']: model + '_uptime.html',
+             '/' + profile['eventlog_page']: model + '_eventlog.html'}
+    return {path: open(os.path.join(FIXTURE_DIR, name), 'rb').read() for path, name in pages.items()}
+
+
+def startModems(models, count, faults, address='127.0.0.1', port=0):
+    # count modems, taking models in turn, on consecutive ports from port (or any free ones, if 0);
+    # returns their servers, each serving from a thread of its own
+    servers = []
+    for i in range(count):
+        model = models[i % len(models)]
+        handler = functools.partial(FakeModemHandler, pages=modemPages(model), faults=faults)
+        server = http.server.ThreadingHTTPServer((address, port + i if port else 0), handler)
+        server.daemon_threads = True
+        server.model = model
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    return servers
+
+
+def addFaultOptions(parser):
+    parser.add_argument('--models', default='sb6183', help='comma-separated models, taken in turn (default sb6183)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each answer')
+    parser.add_argument('--jitter', type=float, default=0.0, help='latency varies by up to this much either way')
+    parser.add_argument('--seed', type=int, help='for repeatable faults')
+    for fault in FAULTS:
+        parser.add_argument('--' + fault.replace('_', '-'), type=float, default=0.0, metavar='CHANCE',
+                            help='chance (0 to 1) of each request getting this fault')
+
+
+def faultsFrom(options):
+    return Faults(options.latency, options.jitter, options.seed,
+                  **{fault: getattr(options, fault) for fault in FAULTS})
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake Arris modems, serving the fixtures with faults')
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8183, help='the first modem\'s port (0 for any free ones)')
+    parser.add_argument('--count', type=int, default=1, help='how many modems')
+    addFaultOptions(parser)
+    options = parser.parse_args()
+    models = [model for model in options.models.split(',') if model]
+    for model in models:
+        if model not in MODELS:
+            parser.error('no fixtures for model ' + model)
+
+    faults = faultsFrom(options)
+    servers = startModems(models, options.count, faults, options.address, options.port)
+    for server in servers:
+        print('{} at http://{}:{}/'.format(server.model.upper(), *server.server_address[:2]))
+    print('MODEM_HOSTS=' + ' '.join('{}:{}'.format(*server.server_address[:2]) for server in servers))
+    try:
+        while True:
+            time.sleep(60)
+            print(' '.join('{}={}'.format(name, count) for name, count in faults.counts.items()), flush=True)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
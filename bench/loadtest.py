@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+    Drives arris.py's scrape against many fake modems (fakemodem.py) at once, to see how it copes
+
+    For --seconds, rounds of scrapes of every modem are run, --concurrency at a time, as fleet mode
+    does. Prints the scrapes per second, how long rounds took, how each scrape turned out (including
+    any exception that escaped the plugin, with where it came from) and how much memory grew from
+    the first round to the last.
+
+    loadtest.py --modems 50 --concurrency 16 --seconds 30 --latency 0.2 --jitter 0.2 --reset 0.02 --truncate 0.05
+
+    (Without the 'requests' package, each scrape is just the status page, fetched with urllib and
+    handed to the plugin as a file, as launch.sh does.)
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import http.client
+import os
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+import traceback
+import urllib.request
+
+import fakemodem
+
+arris = fakemodem.arris
+
+
+def scrapeOnce(host, timeout):
+    # one modem's report, as fleet mode would get it
+    try:
+        import requests  # noqa: F401
+    except ImportError:
+        aReport = {}
+        try:
+            page = urllib.request.urlopen('http://' + host + '/', timeout=timeout).read()
+        except (OSError, http.client.HTTPException):  # what requests would have caught, in the plugin
+            return {'model_name': 'modem_offline'}
+        fd, path = tempfile.mkstemp(dir=os.environ['MUNIN_PLUGSTATE'], suffix='.html')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(page)
+            if not arris.getStatusIntoReport(path, aReport):
+                aReport['model_name'] = 'modem_offline'
+        finally:
+            os.unlink(path)
+        return aReport
+    return arris.collectModemReport(host, timeout)
+
+
+def outcome(aReport):
+    if aReport.get('model_name', 'modem_offline') == 'modem_offline':
+        return 'offline'
+    if aReport.get('uptime_seconds') == 'U':
+        return 'no uptime'
+    return 'ok'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test arris.py against fake modems')
+    parser.add_argument('--modems', type=int, default=20, help='how many fake modems (default 20)')
+    parser.add_argument('--concurrency', type=int, default=arris.FLEET_MAX_WORKERS,
+                        help='scrapes at once (default FLEET_MAX_WORKERS)')
+    parser.add_argument('--timeout', type=float, default=arris.FLEET_TIMEOUT,
+                        help='seconds per page request (default FLEET_TIMEOUT)')
+    parser.add_argument('--seconds', type=float, default=10, help='how long to keep at it (default 10)')
+    fakemodem.addFaultOptions(parser)
+    parser.set_defaults(models='sb6183,sb8200')
+    options = parser.parse_args()
+
+    faults = fakemodem.faultsFrom(options)
+    servers = fakemodem.startModems(options.models.split(','), options.modems, faults)
+    hosts = ['{}:{}'.format(*server.server_address[:2]) for server in servers]
+    stateDir = tempfile.mkdtemp(prefix='arris-loadtest-')
+    os.environ['MUNIN_PLUGSTATE'] = stateDir
+
+    outcomes = collections.Counter()
+    crashes = {}  # exception type: where the first one came from
+    roundTimes = []
+    memory = []
+    tracemalloc.start()
+    started = time.perf_counter()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=options.concurrency) as pool:
+            while time.perf_counter() - started < options.seconds:
+                roundStarted = time.perf_counter()
+                for job in [pool.submit(scrapeOnce, host, options.timeout) for host in hosts]:
+                    try:
+                        outcomes[outcome(job.result())] += 1
+                    except Exception as the_error:  # noqa: B902 - any of them is a finding
+                        name = type(the_error).__name__
+                        outcomes['crash: ' + name] += 1
+                        crashes.setdefault(name, ''.join(traceback.format_exception(the_error)[-3:]))
+                roundTimes.append(time.perf_counter() - roundStarted)
+                memory.append(tracemalloc.get_traced_memory()[0])
+    finally:
+        elapsed = time.perf_counter() - started
+        tracemalloc.stop()
+        for server in servers:
+            server.shutdown()
+        shutil.rmtree(stateDir)
+
+    scrapes = sum(outcomes.values())
+    print('{} modems, {} at a time: {} rounds, {} scrapes in {:.1f}s, {:.1f} scrapes/s'.format(
+        len(hosts), options.concurrency, len(roundTimes), scrapes, elapsed, scrapes / elapsed))
+    if roundTimes:
+        print('round seconds: median {:.3f}, max {:.3f}'.format(statistics.median(roundTimes), max(roundTimes)))
+        print('memory: {:.0f}kB after the first round, {:.0f}kB after the last; peak RSS {:.0f}MB'.format(
+            memory[0] / 1024, memory[-1] / 1024, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    print('faults served:', ' '.join('{}={}'.format(name, count) for name, count in faults.counts.items()))
+    for name, count in outcomes.most_common():
+        print('{:>8} {}'.format(count, name))
+    for name, where in crashes.items():
+        print('\nfirst', name + ':\n' + where, end='')
+    return 1 if crashes else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())